@@ -1,10 +1,86 @@
+"""
+Base class of the actions (posts, reshares and views) and helpers for their ids.
+Action ids are 64-bit integers encoding the kind of action, the user and a per-user counter:
+    kind (2 bits) | user id (31 bits) | counter (30 bits)
+and are converted back to the string form (e.g. "P3_u12") only when written on disk.
+make_aid raises ValueError for a user id or counter that does not fit in its bits,
+instead of spilling into the bits of another field (i.e. another user's ids).
+"""
+
+import numpy as np
+
+# Kinds of action
+POST = 0
+RESHARE = 1
+VIEW = 2
+KIND_PREFIX = ("P", "R", "V")
+
+# Sentinel for a missing id (e.g. reshared fields of an original post)
+NO_ID = -1
+
+UID_BITS = 31
+COUNTER_BITS = 30
+
+
+def make_aid(kind: int, uid: int, counter: int) -> int:
+    """Encode an action id
+
+    Args:
+        kind (int): POST, RESHARE or VIEW
+        uid (int): id of the user that performed the action
+        counter (int): per-user counter of the actions of this kind
+
+    Returns:
+        int: the action id
+
+    Raises:
+        ValueError: if uid or counter is out of range (arrays are checked element-wise)
+    """
+    if isinstance(uid, np.ndarray) or isinstance(counter, np.ndarray):
+        in_range = np.all((uid >= 0) & (uid < 1 << UID_BITS)) and np.all(
+            (counter >= 0) & (counter < 1 << COUNTER_BITS)
+        )
+    else:
+        in_range = 0 <= uid < 1 << UID_BITS and 0 <= counter < 1 << COUNTER_BITS
+    if not in_range:
+        raise ValueError(
+            f"Action id out of range: uid must be < 2**{UID_BITS} "
+            f"and counter < 2**{COUNTER_BITS}"
+        )
+    return (kind << (UID_BITS + COUNTER_BITS)) | (uid << COUNTER_BITS) | counter
+
+
+def aid_kind(aid: int) -> int:
+    return aid >> (UID_BITS + COUNTER_BITS)
+
+
+def aid_uid(aid: int) -> int:
+    return (aid >> COUNTER_BITS) & ((1 << UID_BITS) - 1)
+
+
+def aid_counter(aid: int) -> int:
+    return aid & ((1 << COUNTER_BITS) - 1)
+
+
+def format_uid(uid: int) -> str:
+    """String form of a user id, as written in ids and on disk (e.g. 12 -> "u12")"""
+    return "u" + str(uid)
+
+
+def format_aid(aid: int) -> str:
+    """String form of an action id, as written on disk (e.g. "P3_u12")"""
+    return KIND_PREFIX[aid_kind(aid)] + str(aid_counter(aid)) + "_" + format_uid(aid_uid(aid))
+
+
 class Action:
-    def __init__(self, aid: str, uid: str) -> None:
+    __slots__ = ("aid", "uid")
+
+    def __init__(self, aid: int, uid: int) -> None:
         self.aid = aid
         self.uid = uid
 
     def write_action(self):
         return (
-            self.aid,
-            self.uid,
+            format_aid(self.aid),
+            format_uid(self.uid),
         )
@@ -0,0 +1,254 @@
+"""
+Vectorized version of User.make_actions for a batch of users.
+All the random decisions of the batch (post or reshare, reshare targets, qualities,
+appeals and topics of the new posts) are drawn as arrays, and the Message/View objects
+are created only at the end. The draws follow the same distributions as the per-object
+path (User.make_actions, User.reshare_message, User.post_message), not the same stream.
+"""
+
+import numpy as np
+from message import Message
+from view import View, compact_views
+from action import POST, RESHARE, VIEW, NO_ID, make_aid
+from quality import QUALITY_SAMPLER
+
+
+def draw_post_qualities(
+    quality_params: np.ndarray, rng: np.random.Generator
+) -> np.ndarray:
+    """Vectorized Message.custom_beta_quality, one draw from the sampler per distinct params
+
+    Args:
+        quality_params (np.ndarray): (n, 4) alpha, beta, lower and upper bound of each post
+        rng (np.random.Generator): random generator
+
+    Returns:
+        np.ndarray: quality of each post (rounded to 2 decimals)
+    """
+    quality = np.empty(len(quality_params))
+    if not len(quality_params):
+        return quality
+    distinct, inverse = np.unique(quality_params, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for i, params in enumerate(distinct.tolist()):
+        posts = np.flatnonzero(inverse == i)
+        quality[posts] = QUALITY_SAMPLER.draw(tuple(params), len(posts), rng)
+    return quality
+
+
+def draw_post_topics(
+    interests: np.ndarray,
+    rng: np.random.Generator,
+    max_topics: int = 5,
+    noise_level: float = 0.2,
+) -> np.ndarray:
+    """Vectorized User.generate_message_vector
+
+    Args:
+        interests (np.ndarray): (n, n_topics) topic interests of the author of each post
+        rng (np.random.Generator): random generator
+        max_topics (int): number of max topics for each message. Defaults to 5.
+        noise_level (float): level of out of scope content for each message. Defaults to 0.2.
+
+    Returns:
+        np.ndarray: (n, n_topics) topic vector of each post
+    """
+    n_posts, n_topics = interests.shape
+    weights = np.where(interests > 0, interests, 0)
+    cum_weights = np.cumsum(weights, axis=1)
+    last_interest = n_topics - 1 - np.argmax(weights[:, ::-1] > 0, axis=1)
+
+    # Sample (with replacement) 1 to max_topics topics weighted by interest
+    n_samples = rng.integers(1, max_topics + 1, size=n_posts)
+    samples = rng.random((n_posts, max_topics)) * cum_weights[:, -1:]
+    sampled = np.minimum(
+        (cum_weights[:, None, :] <= samples[:, :, None]).sum(axis=2),
+        last_interest[:, None],
+    )
+    rows, columns = np.nonzero(np.arange(max_topics) < n_samples[:, None])
+    chosen = np.zeros((n_posts, n_topics), dtype=bool)
+    chosen[rows, sampled[rows, columns]] = True
+
+    # Values based on interest, scaled by some fuzziness
+    variation = rng.uniform(0.5, 1.0, size=(n_posts, n_topics))
+    topics = np.where(chosen, np.round(interests * variation, 3), 0.0)
+
+    # Add a possible noise topic from outside the user's interest scope
+    noise_topic = rng.integers(0, n_topics, size=n_posts)
+    noisy = (rng.random(n_posts) < noise_level) & (
+        interests[np.arange(n_posts), noise_topic] == 0
+    )
+    topics[noisy, noise_topic[noisy]] = np.round(
+        rng.uniform(0.1, 1.0, size=noisy.sum()), 3
+    )
+    return topics
+
+
+def draw_reshare_targets(
+    appeals: np.ndarray,
+    feed_start: np.ndarray,
+    feed_len: np.ndarray,
+    reshare_owner: np.ndarray,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """
+    Vectorized target choice of User.reshare_message: the target is the last message
+    of the feed with appeal >= a uniform threshold, or a random message if there is none.
+
+    Args:
+        appeals (np.ndarray): appeals of the messages of all the feeds, concatenated
+        feed_start (np.ndarray): offset of the feed of each user in appeals
+        feed_len (np.ndarray): length of the feed of each user
+        reshare_owner (np.ndarray): user of each reshare
+        rng (np.random.Generator): random generator
+
+    Returns:
+        np.ndarray: index in appeals of the target of each reshare
+    """
+    # Running max of each reversed feed; feeds are shifted by 2 * user so that
+    # the running max restarts on each feed and a single searchsorted finds all the targets
+    segment = np.repeat(np.arange(len(feed_len)), feed_len)
+    reversed_index = 2 * feed_start[segment] + feed_len[segment] - 1 - np.arange(len(appeals))
+    running_max = np.maximum.accumulate(appeals[reversed_index] + 2 * segment)
+
+    thresholds = rng.random(len(reshare_owner))
+    position = (
+        np.searchsorted(running_max, thresholds + 2 * reshare_owner, side="left")
+        - feed_start[reshare_owner]
+    )
+    owner_len = feed_len[reshare_owner]
+    found = position < owner_len
+    offset = np.where(found, owner_len - 1 - position, rng.integers(0, owner_len))
+    return feed_start[reshare_owner] + offset
+
+
+def make_actions_batch(
+    users: list,
+    rng: np.random.Generator,
+    view_recording: str = "full",
+    view_sample_rate: float = 0.1,
+) -> list:
+    """Activate a batch of users (see User.make_actions)
+
+    Args:
+        users (list): users to activate, their counters and feeds are updated
+        rng (np.random.Generator): random generator
+        view_recording (str): how views are recorded (see view.VIEW_RECORDINGS),
+            with a compact recording no View object is created
+        view_sample_rate (float): probability to keep a view with the sampled recording
+
+    Returns:
+        list: (actions, passive_actions) of each user
+    """
+    if not users:
+        return []
+    n_users = len(users)
+    n_actions = np.array([user.post_per_day for user in users], dtype=np.int64)
+    feed_len = np.array([len(user.newsfeed) for user in users], dtype=np.int64)
+    feed_start = np.cumsum(feed_len) - feed_len
+    mu = np.array([user.mu for user in users])
+    is_shadow = np.array([user.is_shadow for user in users], dtype=bool)
+
+    # Post or reshare (only users with a feed can reshare)
+    owner = np.repeat(np.arange(n_users), n_actions)
+    is_reshare = (feed_len[owner] > 0) & (rng.random(len(owner)) > mu[owner])
+
+    # Reshare targets
+    feed = [message for user in users for message in user.newsfeed]
+    appeals = np.array([message.appeal for message in feed], dtype=np.float64)
+    reshare_owner = owner[is_reshare]
+    targets = draw_reshare_targets(appeals, feed_start, feed_len, reshare_owner, rng)
+
+    # Quality, appeal and topics of the new posts
+    post_owner = owner[~is_reshare]
+    has_params = np.array([bool(user.quality_params) for user in users])
+    quality_params = np.array(
+        [user.quality_params if user.quality_params else (1, 1, 0, 1) for user in users],
+        dtype=np.float64,
+    )
+    quality = draw_post_qualities(quality_params[post_owner], rng).tolist()
+    # Posts of the users without quality params have no quality (see Message.__init__)
+    quality = [
+        q if has else None for q, has in zip(quality, has_params[post_owner].tolist())
+    ]
+    appeal = 1 - (1 - rng.random(len(post_owner))) ** (1 / 5)
+    appeal[is_shadow[post_owner]] = 0
+    interests = np.array([user.user_topics for user in users], dtype=np.float64)
+    topics = draw_post_topics(interests[post_owner], rng)
+
+    # Materialize the actions in the order they were taken
+    results = [([], []) for _ in users]
+    posts = zip(quality, appeal.tolist(), topics.tolist())
+    targets = iter(targets.tolist())
+    n_reshares = np.zeros(n_users, dtype=np.int64)
+    for i, reshare in zip(owner.tolist(), is_reshare.tolist()):
+        user = users[i]
+        actions, passive_actions = results[i]
+        if reshare:
+            target = feed[next(targets)]
+            n_reshares[i] += 1
+            # With a compact recording views are recorded below, as arrays
+            for msg in user.newsfeed if view_recording == "full" else ():
+                vid = make_aid(VIEW, user.uid, user.view_counter)
+                passive_actions.append(
+                    View(vid=vid, uid=user.uid, parent_mid=msg.aid, parent_uid=msg.uid)
+                )
+                user.view_counter += 1
+            actions.append(
+                Message.from_fields(
+                    mid=make_aid(RESHARE, user.uid, user.repost_counter),
+                    uid=user.uid,
+                    topics=target.topics,
+                    is_shadow=user.is_shadow,
+                    appeal=target.appeal,
+                    quality=target.quality,
+                    exposure=target.exposure,
+                    reshared_id=target.aid,
+                    reshared_original_id=(
+                        target.reshared_original_id
+                        if target.reshared_id != NO_ID
+                        else target.aid
+                    ),
+                    reshared_user_id=target.uid,
+                )
+            )
+            user.repost_counter += 1
+        else:
+            post_quality, post_appeal, post_topics = next(posts)
+            actions.append(
+                Message.from_fields(
+                    mid=make_aid(POST, user.uid, user.post_counter),
+                    uid=user.uid,
+                    topics=post_topics,
+                    is_shadow=user.is_shadow,
+                    appeal=post_appeal,
+                    quality=post_quality,
+                    quality_params=user.quality_params,
+                )
+            )
+            user.post_counter += 1
+
+    if view_recording != "full":
+        # Every reshare views the whole feed (view ids are consecutive)
+        feed_mids = np.array([message.aid for message in feed], dtype=np.int64)
+        feed_uids = np.array([message.uid for message in feed], dtype=np.int64)
+        for i in np.flatnonzero(n_reshares).tolist():
+            user = users[i]
+            feed_slice = slice(feed_start[i], feed_start[i] + feed_len[i])
+            n_views = n_reshares[i] * feed_len[i]
+            results[i][1].extend(
+                compact_views(
+                    uid=user.uid,
+                    vids=make_aid(VIEW, user.uid, user.view_counter + np.arange(n_views)),
+                    parent_mids=np.tile(feed_mids[feed_slice], n_reshares[i]),
+                    parent_uids=np.tile(feed_uids[feed_slice], n_reshares[i]),
+                    recording=view_recording,
+                    sample_rate=view_sample_rate,
+                    rng=rng,
+                )
+            )
+            user.view_counter += int(n_views)
+
+    for user in users:
+        user.newsfeed = user.newsfeed[: user.cut_off]
+    return results
@@ -1,11 +1,24 @@
 """
 An agent pool manager handle the pool of parallel running agent processes.
 Main task is to dispatch User/Agent objects to agent processes.
+Dispatch is pull-based: the agent handlers tell the pool manager when they are done
+with a user, and the pool manager keeps a queue of users to activate and hands them out
+to the handlers with the least outstanding work.
 """
 
+from collections import deque
 from mpi4py import MPI
-import random as rnd
 import time
+from transport import make_transport, FEED_BATCH
+from instrumentation import PROFILER
+
+
+def activation_cost(user, network) -> int:
+    """
+    Estimated cost of activating a user: every post/repost of the day
+    scans the feed of the user (see User.make_actions)
+    """
+    return 1 + int(network.post_per_day[user.uid]) * (1 + len(user.newsfeed))
 
 
 def run_agent_pool_manager(
@@ -13,6 +26,11 @@ def run_agent_pool_manager(
     rank: int,
     size: int,
     rank_index: dict,
+    network=None,
+    transport: str = "pickle",
+    agent_batchsize: int = 1,
+    agent_prefetch: int = 2,
+    agent_cost_weighted: bool = True,
 ):
 
     # Verbose: use flush=True to print messages
@@ -21,46 +39,111 @@ def run_agent_pool_manager(
     # Status of the processes
     status = MPI.Status()
 
+    # Pickled objects or packed buffers
+    channel = make_transport(comm_world, transport)
+
     # Ranks of all available agent handler
     agent_handlers_ranks = list(range(rank_index["agent_handler"], size))
     # print("- Agent Pool Manager >> agent process ranks", agent_handlers_ranks, flush=True)
+    recsys_ranks = rank_index["recommender_system"]
+
+    # Users waiting for an agent handler
+    queue = deque()
+    # Costs of the batches dispatched to each handler and not done yet (in dispatch order)
+    outstanding = {handler_rank: deque() for handler_rank in agent_handlers_ranks}
+    load = {handler_rank: 0 for handler_rank in agent_handlers_ranks}
+    dispatch_requests = []
+    # Recommender systems we did not ask for a new batch because the queue is full
+    idle_recsys = deque()
+    # Keep enough users in the queue to fill all the handlers
+    queue_target = len(agent_handlers_ranks) * agent_prefetch * agent_batchsize
+
+    def dispatch():
+        """Hand out batches of queued users to the least loaded handlers that have room"""
+        while queue:
+            available = [
+                handler_rank
+                for handler_rank in agent_handlers_ranks
+                if len(outstanding[handler_rank]) < agent_prefetch
+            ]
+            if not available:
+                break
+            handler_rank = min(available, key=load.__getitem__)
+            batch = [queue.popleft() for _ in range(min(agent_batchsize, len(queue)))]
+            cost = (
+                sum(activation_cost(user, network) for user in batch)
+                if agent_cost_weighted
+                else len(batch)
+            )
+            outstanding[handler_rank].append(cost)
+            load[handler_rank] += cost
+            dispatch_requests.append(
+                channel.isend(batch, dest=handler_rank, kind=FEED_BATCH)
+            )
+        # Forget the requests that are already completed
+        dispatch_requests[:] = [req for req in dispatch_requests if not req.Test()]
+
+    def request_batches():
+        """Ask the idle recommender systems for new batches while the queue is short"""
+        while idle_recsys and len(queue) < queue_target:
+            comm_world.send("ping_agent_pool_manager", dest=idle_recsys.popleft())
+
+    def terminate():
+        """Close the agent handlers once all the recommender systems are closed"""
+        # Send termination signal to all agent handlers and print message
+        # print("- Agent Pool Manager >> termination signal", flush=True)
+        for handler_rank in agent_handlers_ranks:
+            comm_world.send("sigterm", dest=handler_rank)
+        MPI.Request.waitall(dispatch_requests)
+
+        # Wait until all the agent handlers are closed (they are still done with their users)
+        n_closed = 0
+        while n_closed < len(agent_handlers_ranks):
+            if channel.recv(source=MPI.ANY_SOURCE, status=status) == "sigterm":
+                n_closed += 1
+
+        # Flush pending incoming messages so we can exit cleanly
+        while comm_world.Iprobe(source=MPI.ANY_SOURCE, status=status):
+            _ = channel.recv(source=MPI.ANY_SOURCE, status=status)
+        comm_world.Barrier()
 
     # Bootstrap sync
     comm_world.Barrier()
 
+    # Get data from recommender system processes
+    for recsys_rank in recsys_ranks:
+        comm_world.send("ping_agent_pool_manager", dest=recsys_rank)
+
+    # Number of recommender systems that sent the termination signal
+    n_closed = 0
+
     while True:
-        
-        # Get data from recommender system process
-        comm_world.send(
-            "ping_agent_pool_manager",
-            dest=rank_index["recommender_system"],
-        )
-
-        # Wait for data from recommender system process
-        data = comm_world.recv(
-            source=rank_index["recommender_system"],
-            status=status,
-        )
+
+        # Wait for data from any recommender system or for an agent handler to be done
+        with PROFILER.phase("recv"):
+            data = channel.recv(
+                source=MPI.ANY_SOURCE,
+                status=status,
+            )
+        source = status.Get_source()
+
+        if source not in recsys_ranks:
+            # An agent handler is done with its oldest batch
+            load[source] -= outstanding[source].popleft()
 
         # Check for termination
-        if data == "sigterm":
-            # Send termination signal to all agent handlers and print message
-            # print("- Agent Pool Manager >> termination signal", flush=True)
-            for i in range(rank_index["agent_handler"], size):
-                comm_world.send("sigterm", dest=i)
-
-            # Flush pending incoming messages so we can exit cleanly
-            while comm_world.Iprobe(source=MPI.ANY_SOURCE, status=status):
-                _ = comm_world.recv(source=MPI.ANY_SOURCE, status=status)
-            comm_world.Barrier()
-            break
-
-        # If is not termination signal, dispatch data to agent handlers
-        dispatch_requests = []
-
-        for user in data:
-            handler_rank = rnd.choice(agent_handlers_ranks)
-            req = comm_world.isend(user, dest=handler_rank)
-            dispatch_requests.append(req)
+        elif data == "sigterm":
+            n_closed += 1
+            # Keep dispatching until all the recommender systems are closed
+            if n_closed == len(recsys_ranks):
+                terminate()
+                break
 
-        MPI.Request.waitall(dispatch_requests)
+        else:
+            # Queue the batch, the same recommender system will be asked for the next one
+            queue.extend(data)
+            idle_recsys.append(source)
+
+        with PROFILER.phase("dispatch"):
+            dispatch()
+            request_batches()
@@ -6,6 +6,13 @@ and post/repost messages that will be shown to their followers
 import numpy as np
 from mpi4py import MPI
 import time
+from user import Activation
+from transport import make_transport, AGENT_REPLY, WRITER_BATCH
+from writer_process import assigned_writer
+from action_kernel import make_actions_batch
+from view import record_views
+from convergence import PartialAggregates
+from instrumentation import PROFILER
 
 
 def run_agent(
@@ -13,6 +20,13 @@ def run_agent(
     rank: int,
     size: int,
     rank_index: dict,
+    network=None,
+    user_transfer: str = "object",
+    transport: str = "pickle",
+    action_engine: str = "object",
+    view_recording: str = "full",
+    view_sample_rate: float = 0.1,
+    convergence_source: str = "stream",
 ):
 
     # Verbose: use flush=True to print messages
@@ -21,34 +35,108 @@ def run_agent(
     # Status of the processes
     status = MPI.Status()
 
+    # Pickled objects or packed buffers
+    channel = make_transport(comm_world, transport)
+
+    # Writer rank that persists our actions, if any
+    writer_rank = assigned_writer(rank, rank_index) if rank_index["writer"] else None
+
+    # Random generator of the numpy action engine
+    rng = np.random.default_rng()
+
+    # Partial aggregates of our messages, combined by the analyzer
+    reduction = None
+    if convergence_source == "reduce":
+        reduction = PartialAggregates.create(comm_world, rank_index)
+
     # Bootstrap sync
     comm_world.Barrier()
 
     while True:
 
-        # Receive package that contains (friend ids, messages) from agent_pool_manager
+        # Receive a batch of users (friend ids, messages) from agent_pool_manager
         # Wait for agent pack to process
-        data = comm_world.recv(
-            source=rank_index["agent_pool_manager"],
-            status=status,
-        )
+        with PROFILER.phase("recv"):
+            data = channel.recv(
+                source=rank_index["agent_pool_manager"],
+                status=status,
+            )
 
         # Check if the data is a termination signal and break the loop propagating the sigterm
         if data == "sigterm":
             # print("- Agent process >> termination signal, stopping simulation...")
             comm_world.send(data, dest=rank_index["policy_filter"])
+            comm_world.send((data, 0), dest=rank_index["data_manager"])
+            if writer_rank is not None:
+                comm_world.send(data, dest=writer_rank)
+            comm_world.send(data, dest=rank_index["agent_pool_manager"])
+            if reduction is not None:
+                reduction.close()
             # Flush pending incoming messages so we can exit cleanly
             while comm_world.Iprobe(source=MPI.ANY_SOURCE, status=status):
-                _ = comm_world.recv(source=MPI.ANY_SOURCE, status=status)
+                _ = channel.recv(source=MPI.ANY_SOURCE, status=status)
             comm_world.Barrier()
             break
-        user = data
-        
-        new_msgs, passive_actions = user.make_actions()
-        
-        # Repack the agent (updated feed) and actions (messages he produced)
-        agent_pack_reply = (user, new_msgs, passive_actions)
 
+        users = data
+        PROFILER.count("batch_size", len(users))
+        if user_transfer == "delta":
+            # Rebuild the users from the shared network and the activations
+            users = [activation.apply(network.make_user(activation.uid)) for activation in users]
+
+        # Activate the whole batch and send a single reply
+        with PROFILER.phase("make_actions"):
+            if action_engine == "numpy":
+                batch_actions = make_actions_batch(
+                    users, rng, view_recording=view_recording, view_sample_rate=view_sample_rate
+                )
+            else:
+                batch_actions = [
+                    (new_msgs, record_views(passive_actions, view_recording, view_sample_rate, rng))
+                    for new_msgs, passive_actions in (user.make_actions() for user in users)
+                ]
+
+        if reduction is not None:
+            reduction.add(
+                len(users),
+                [msg.quality for new_msgs, _ in batch_actions for msg in new_msgs],
+            )
+            reduction.contribute()
+
+        if writer_rank is not None:
+            # Send the views to the writer, they are not needed by the other processes
+            # (the messages get to the writer from the data manager, once they have a time)
+            with PROFILER.phase("send_writer"):
+                channel.send(
+                    [
+                        (Activation.from_user(user), [], passive_actions)
+                        for user, (_, passive_actions) in zip(users, batch_actions)
+                    ],
+                    dest=writer_rank,
+                    kind=WRITER_BATCH,
+                )
+            batch_actions = [(new_msgs, []) for new_msgs, _ in batch_actions]
+
+        agent_pack_replies = []
+        for user, (new_msgs, passive_actions) in zip(users, batch_actions):
+            if user_transfer == "delta":
+                # Send back only the updated counters
+                user = Activation.from_user(user)
+
+            # Repack the agent (updated feed) and actions (messages he produced)
+            agent_pack_replies.append((user, new_msgs, passive_actions))
 
-        comm_world.send(("ping_agent_pool_manager", agent_pack_reply), dest=rank_index["data_manager"])
-        comm_world.send(data, dest=rank_index["policy_filter"])
+        with PROFILER.phase("send"):
+            channel.send(
+                ("ping_agent_pool_manager", agent_pack_replies),
+                dest=rank_index["data_manager"],
+                kind=AGENT_REPLY,
+            )
+            comm_world.send(
+                [user.uid for user, _, _ in agent_pack_replies]
+                if user_transfer == "delta"
+                else data,
+                dest=rank_index["policy_filter"],
+            )
+        # Ask the agent pool manager for more work
+        comm_world.send("ready", dest=rank_index["agent_pool_manager"])
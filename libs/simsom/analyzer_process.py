@@ -3,13 +3,24 @@ Reponsible for monitoring the convergence of the simulation.
 Send termination signal to all processes when the simulation has converged.
 """
 
+import os
 import time
-import csv
 import numpy as np
 from mpi4py import MPI
-import simtools
 import time
-import pandas as pd
+from transport import make_transport
+from convergence import (
+    RunningStats,
+    ActionCounters,
+    PartialAggregates,
+    N_ACTIVATIONS,
+    N_MESSAGES,
+    QUALITY_SUM,
+    QUALITY_SQUARES,
+)
+from view import trim_views
+from output_writer import make_writer, open_output, write_index, write_cutoff
+from instrumentation import PROFILER
 
 # Path files
 time_now = int(time.time())
@@ -17,38 +28,10 @@ folder_path = f"files/{time_now}"
 file_path_activity = folder_path + "/activities.csv"
 file_path_passivity = folder_path + "/passivities.csv"
 rho = 0.8
+# Seconds between two checks of the reductions when there is nothing to receive
+reduce_poll_interval = 0.001
 
 
-def resize_output(size: int):
-    """Resize output file to make sure we do not
-        persist data that has been created after the
-        interrupt signal from convergence monitor.
-        The function read and remove the part of the file
-        that we shouldn't have because of send / receive delays
-
-    Args:
-        size (int): size of the file that we should have
-    """
-    df = pd.read_csv(file_path_activity)
-    df = df[:size]
-    df.to_csv(
-        file_path_activity,
-        lineterminator="\n",
-        index=False,
-        encoding="utf-8",
-    )
-    # get last user id from activity file so we can clean also the passivity file
-    last_user = df.tail(1).user_id.values[0]
-    df = pd.read_csv(file_path_passivity)
-    last_idx = df[df['user_id'] == last_user].last_valid_index()
-    df = df.loc[:last_idx]
-    df.to_csv(
-        file_path_passivity,
-        lineterminator="\n",
-        index=False,
-        encoding="utf-8",
-    )
-
 def update_quality(current_quality, overall_avg_quality) -> None:
     """
     Update quality using exponential moving average to ensure stable state at convergence
@@ -96,7 +79,21 @@ def run_analyzer(
     # Params for saving activities on disk
     save_active_interactions: bool=True,
     save_passive_interactions: bool=True,  
-
+    # Pickled objects or packed buffers
+    transport: str = "pickle",
+    # How the views are recorded (see view.VIEW_RECORDINGS)
+    view_recording: str = "full",
+    # Params for the writer of the output files (see output_writer)
+    output_writer: str = "direct",
+    output_flush_rows: int = 10000,
+    output_flush_interval: float = 1.0,
+    output_format: str = "csv",
+    output_chunk_rows: int = 100000,
+    # Where the convergence statistics come from: the stream of actions or the partial
+    # aggregates of the agent handlers (see convergence.PartialAggregates)
+    convergence_source: str = "stream",
+    # Users per batch of the data manager, to count the batches of the partial aggregates
+    batch_size: int = 10,
 ):
     """
     Function that takes care of calculating the convergence condition and stop execution
@@ -108,18 +105,17 @@ def run_analyzer(
     """
 
     status = MPI.Status()
+    channel = make_transport(comm_world, transport)
 
-    n_data = 0                  # keep track of the number of messages
-    intermediate_n_user = 0     # keep track of the number of users
-    interval_quality = 0        # keep track of the quality of the messages for interval printing
-    quality_sum = 0             # keep track of the quality of the messages
-    count = 0                   # keep track of the number of messages for verbose debug
-    current_quality_list = []   # list of qualities for the sliding window
-    previous_quality = None     # quality of the previous window
-    feeds = {}                  # dictionary of feeds for the users, this is used to calculate diversity, quality, etc.
-    users = []                  # list of users for the ema quality
-    current_quality = 1         # value to calculate the current quality each N iterations (or after T time)
-    csv_out_act = None
+    quality = RunningStats()            # keep track of the quality (and number) of the messages
+    intermediate_n_user = 0             # keep track of the number of users
+    n_stored = 0                        # number of messages written (or counted, with writer ranks)
+    interval_quality = RunningStats()   # keep track of the quality of the messages for interval printing
+    window_quality = RunningStats()     # quality of the messages of the current sliding window
+    previous_quality = None             # quality of the previous window
+    n_ema_users = 0                     # number of batches since the last check of the ema quality
+    next_print = print_interval         # number of users of the next interval printing
+    current_quality = 1                 # value to calculate the current quality each N iterations (or after T time)
     
 
     convergence_flags = enforce_single_convergence_method(
@@ -142,113 +138,216 @@ def run_analyzer(
     
     print(f"Execution with {exec_name}")
     
-    # Initialize files
-    simtools.init_files(folder_path, file_path_activity, file_path_passivity)
+    # With the partial aggregates the actions reach the analyzer only to be saved
+    stored_target = (
+        max_iteration_target
+        if convergence_source == "stream" or save_active_interactions or save_passive_interactions
+        else 0
+    )
+    writer_ranks = rank_index["writer"]
+    if writer_ranks:
+        # The writer ranks persist the actions, each one in its own segment of the files
+        for writer_rank in writer_ranks:
+            comm_world.send((file_path_activity, file_path_passivity), dest=writer_rank)
+        os.makedirs(folder_path, exist_ok=True)
+        write_index(
+            folder_path,
+            output_format,
+            {"activity": file_path_activity, "passivity": file_path_passivity},
+            len(writer_ranks),
+        )
+        save_active_interactions = save_passive_interactions = False
+        writer = make_writer("direct", {})
+        # Actions counted by the analyzer, per user
+        counters = ActionCounters(n_users)
+    else:
+        counters = None
+        # Keep the output files open for the whole run
+        writer = open_output(
+            file_path_activity,
+            file_path_passivity,
+            view_recording=view_recording,
+            save_active_interactions=save_active_interactions,
+            save_passive_interactions=save_passive_interactions,
+            output_writer=output_writer,
+            output_flush_rows=output_flush_rows,
+            output_flush_interval=output_flush_interval,
+            output_format=output_format,
+            output_chunk_rows=output_chunk_rows,
+        )
+
+    # Partial aggregates of the agent handlers, combined in rounds of reductions
+    reduction = None
+    if convergence_source == "reduce":
+        reduction = PartialAggregates.create(comm_world, rank_index)
+        previous_totals = np.zeros_like(reduction.result)
 
     # Bootstrap sync
     comm_world.Barrier()
 
+    if reduction is not None:
+        reduction.start()
+
+    def store(data, limit: int = None) -> tuple:
+        """Write the actions of a batch received from the recommender systems
+
+        Args:
+            data: batch of actions (or statistics of the batch, with writer ranks)
+            limit (int): max number of messages to keep
+
+        Returns:
+            list: qualities of the messages kept
+        """
+        nonlocal n_stored
+        if writer_ranks:
+            # Statistics of the batch, the actions were sent to the writer ranks
+            activations, aids, qualities = data
+            activities, passivities = [], []
+        else:
+            activations = [activation for activation, _, _ in data]
+            activities = [msg for _, active_actions, _ in data for msg in active_actions]
+            passivities = [
+                action for _, _, passive_actions in data for action in passive_actions
+            ]
+            qualities = [m.quality for m in activities]
+        if limit is not None and len(qualities) >= limit:
+            # This batch reaches the target: keep the views up to the last one of the
+            # author of the last kept message (as the output was trimmed at termination)
+            activities = activities[:limit]
+            qualities = qualities[:limit]
+            if not qualities:
+                # The target was already reached (see the reduce path)
+                return qualities
+            if activities and view_recording != "exposure":
+                passivities = trim_views(passivities, activities[-1].uid)
+        n_stored += len(qualities)
+        if counters is not None:
+            counters.update(activations, aids[: len(qualities)])
+        PROFILER.count("messages", len(qualities))
+        with PROFILER.phase("write"):
+            # Write the active interactions (post/repost)
+            if save_active_interactions:
+                writer.write("activity", activities)
+            # Write the passive interactions (view)
+            if save_passive_interactions:
+                writer.write("passivity", passivities)
+        return qualities
+
+    def stream_limit() -> int:
+        """Max number of messages to store from the next batch"""
+        # Keep exactly max_iteration_target messages, so that the output files
+        # end with the batch that reached the target and need no resizing
+        return max_iteration_target - n_stored if max_interactions_method else None
+
     # Function to terminate the process and print information
     def clean_termination() -> None:
         """Clean termination of the process"""
         # print("- Analyzer >> GOAL REACHED, TERMINATING SIMULATION...", flush=True)
-        comm_world.send("sigterm", dest=rank_index["recommender_system"])
+        for recsys_rank in rank_index["recommender_system"]:
+            comm_world.send("sigterm", dest=recsys_rank)
         # print("- Analyzer >> sent termination signal to recommender system", flush=True)
+        # Discard the data sent before the recommender systems got the signal
+        n_closed = 0
+        while n_closed < len(rank_index["recommender_system"]):
+            if channel.recv(source=MPI.ANY_SOURCE, status=status) == "sigterm":
+                n_closed += 1
         # Flush pending incoming messages
         while comm_world.Iprobe(source=MPI.ANY_SOURCE, status=status):
-            _ = comm_world.recv(source=MPI.ANY_SOURCE, status=status)
+            _ = channel.recv(source=MPI.ANY_SOURCE, status=status)
+        if reduction is not None:
+            # The agent handlers leave the reductions once they see the final round
+            reduction.close(final=True)
         comm_world.Barrier()
         # print("- Analyzer >> flushed pending messages", flush=True)
+        # Write the buffered rows to disk
+        with PROFILER.phase("close"):
+            writer.close()
+        if counters is not None:
+            write_cutoff(folder_path, counters.limits)
 
     while True:
 
-        # Get data from policy filter
-        data = comm_world.recv(source=rank_index["recommender_system"], status=status)
-        # Unpack the data
-        user, activities, passivities = data
-        # Count the number of messages
-        n_data += len(activities)
-        intermediate_n_user += 1
-
-        # Write the data to the files
-        # Write the active interactions (post/repost)
-        if save_active_interactions:
-            out_act = open(file_path_activity, "a", newline="", encoding="utf-8")
-            csv_out_act = csv.writer(out_act)
-        try:
-            for m in activities:
-                quality_sum += m.quality
-                interval_quality += m.quality
-                count += 1
-                if csv_out_act:
-                    csv_out_act.writerow(m.write_action())
-        finally:
-            if out_act:
-                out_act.close()
-    
-        # Write the passive interactions (view)
-        if save_passive_interactions:
-            with open(
-                file_path_passivity, "a", newline="", encoding="utf-8"
-            ) as out_pas:   
-                csv_out_pas = csv.writer(out_pas)
-                for a in passivities:
-                    csv_out_pas.writerow(a.write_action())
+        if reduction is None:
+            # Get data from the recommender systems
+            with PROFILER.phase("recv"):
+                data = channel.recv(source=MPI.ANY_SOURCE, status=status)
+            batch_quality = RunningStats.from_values(store(data, stream_limit()))
+            n_batches = 1
+        else:
+            # Only write the actions, the statistics come from the agent handlers
+            while comm_world.Iprobe(source=MPI.ANY_SOURCE, status=status):
+                store(channel.recv(source=MPI.ANY_SOURCE, status=status), stream_limit())
+            if not reduction.poll():
+                with PROFILER.phase("idle"):
+                    time.sleep(reduce_poll_interval)
+                continue
+            # Messages produced since the previous round
+            increment = reduction.result - previous_totals
+            previous_totals = reduction.result.copy()
+            reduction.start()
+            batch_quality = RunningStats.from_sums(
+                increment[N_MESSAGES], increment[QUALITY_SUM], increment[QUALITY_SQUARES]
+            )
+            if not increment[N_ACTIVATIONS]:
+                continue
+            # Count the batches of the recommender systems, as the stream path does
+            n_batches = increment[N_ACTIVATIONS] / batch_size
+
+        # Count the number of messages and their quality
+        quality.merge(batch_quality)
+        interval_quality.merge(batch_quality)
+        intermediate_n_user += n_batches
 
         if verbose:
-            if intermediate_n_user % print_interval == 0:
-                print(f"Intermediate stats after {intermediate_n_user} users: interval quality --> {round(interval_quality / count, 2)}", flush=True)
-                count = 0
-                interval_quality = 0
+            if intermediate_n_user >= next_print:
+                # No message may have arrived in the interval
+                interval_mean = round(interval_quality.mean, 2) if interval_quality.count else "n/a"
+                print(f"Intermediate stats after {int(intermediate_n_user)} users: interval quality --> {interval_mean}", flush=True)
+                interval_quality.reset()
+                next_print += print_interval * (1 + (intermediate_n_user - next_print) // print_interval)
 
         # Based on the method for convergence check if we should stop
         if max_interactions_method:
             # Stop and terminate the process
-            if n_data >= max_iteration_target:
+            # The output also needs the messages still on their way to the analyzer
+            if quality.count >= max_iteration_target and n_stored >= stored_target:
                 clean_termination()
-                # Resize the output file to the number of messages
-                resize_output(max_iteration_target)
-                print("Average quality:", round(quality_sum / n_data, 2), flush=True)
+                print("Average quality:", round(quality.mean, 2), flush=True)
                 break
 
         # Use the convergence with sliding window or based on overleall messages
         elif sliding_window_method:
             # Save the quality of the messages in the current window
-            current_quality_list.extend([m.quality for m in activities])
+            window_quality.merge(batch_quality)
             
             # Calculate the average quality for this window and compare to the previous one, 
             # if the abs difference is less than the threshold break and send termination signal
             
             # Check if we reached the sliding window size 
-            if len(current_quality_list) >= sliding_window_size:
+            if window_quality.count >= sliding_window_size:
                 # Calculate the average quality for this window
-                current_quality = np.mean(current_quality_list)
+                current_quality = window_quality.mean
                 # Calculate the average quality for the previous window
                 if previous_quality is not None:
                     # Check if the difference is less than the threshold
                     if abs(current_quality - previous_quality) <= sliding_window_threshold:
                         clean_termination()
-                        # Resize the output file to the number of messages
-                        # resize_output(n_data)
                         print("Threshold reached:", abs(current_quality - previous_quality), flush=True)
-                        print("Average quality:", round(quality_sum / n_data, 2), flush=True)
+                        print("Average quality:", round(quality.mean, 2), flush=True)
                         break
                 # Update the previous quality
                 previous_quality = current_quality
-                current_quality_list = []
+                window_quality.reset()
         # Use the convergence with exponential moving average
         elif ema_quality_method:
-            users.append(user)
-            feeds[user.uid] = user.newsfeed
-            if len(users) == n_users:
-                users = []
-                quality_diff, new_quality = update_quality(current_quality=current_quality, overall_avg_quality=quality_sum / n_data)
+            n_ema_users += n_batches
+            if n_ema_users >= n_users:
+                n_ema_users = 0
+                quality_diff, new_quality = update_quality(current_quality=current_quality, overall_avg_quality=quality.mean)
                 current_quality = new_quality
                 if quality_diff <= ema_quality_convergence:
                     clean_termination()
-                    # Resize the output file to the number of messages
-                    # resize_output(max_iteration_target)
-                    print("Average quality:", round(quality_sum / n_data, 2), flush=True)
+                    print("Average quality:", round(quality.mean, 2), flush=True)
                     break
                 else:
-                    print(f"Quality diff after {n_data} messages: {quality_diff}")
\ No newline at end of file
+                    print(f"Quality diff after {quality.count} messages: {quality_diff}")
\ No newline at end of file
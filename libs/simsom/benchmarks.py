@@ -0,0 +1,524 @@
+"""
+Microbenchmarks of the simulation kernels, run in a single process (no mpiexec needed).
+
+    python benchmarks.py run --output results.json
+    python benchmarks.py compare baseline.json results.json --threshold 0.2
+
+Each case is set up with fixed seeds (random and np.random), warmed up once and timed
+over repeat rounds of number calls (raised so that a round lasts at least MIN_ROUND
+seconds), interleaved with the rounds of the other cases. The results store the median, min and mean seconds per call of each case.
+The alternative engines (numpy ranking and action engines, buffer transport, compact
+view recordings) are timed next to their reference path, on the same inputs.
+compare flags the cases whose min got slower than the baseline by more than threshold
+(relative) and exits with status 1 if there is any regression, so a baseline saved
+before an optimization can be used to validate it. Changes smaller than min_delta
+seconds per call are noise, whatever their ratio. The min is the least noisy estimate
+of the cost of a call: the other rounds only add the noise of the machine.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import math
+import pickle
+import random
+import platform
+import argparse
+import tempfile
+import statistics
+import numpy as np
+import simtools
+from action import RESHARE, make_aid
+from message import Message
+from user import Activation
+from view import VIEW_RECORDINGS, record_views
+from action_kernel import make_actions_batch
+from inventory import MessageInventory
+from ranking import VectorRanker
+from transport import USER_BATCH, pack, unpack
+from output_writer import open_output
+from recommender_system import (
+    build_feed,
+    build_feed_from_scores,
+    clean_feed,
+    clean_feed_slots,
+    calculate_cosine_similarity,
+)
+
+SEED = 42
+# Min seconds of a round, the number of calls of the faster cases is raised to reach it
+MIN_ROUND = 0.05
+# Quality params of the messages (see simtools.QUALITYDISTR)
+QUALITY_PARAMS = (0.5, 0.15, 0, 1)
+
+
+def seed_all(seed: int = SEED) -> None:
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def make_messages(n_messages: int, n_reshared: int = 0) -> list:
+    """
+    Messages of random users with clock times, the last n_reshared are reshares
+    of the first messages
+
+    Args:
+        n_messages (int): number of messages
+        n_reshared (int): number of reshares among them
+
+    Returns:
+        list: messages
+    """
+    users = simtools.init_network(net_size=100, p=0.5, k_out=3, seed=SEED)
+    messages = []
+    for i in range(n_messages):
+        user = users[i % len(users)]
+        if i >= n_messages - n_reshared:
+            original = messages[random.randrange(n_messages - n_reshared)]
+            message = Message(
+                mid=make_aid(RESHARE, user.uid, i),
+                uid=user.uid,
+                quality_params=None,
+                topics=original.topics,
+                is_shadow=False,
+            )
+            message.quality = original.quality
+            message.reshared_id = original.aid
+            message.reshared_original_id = original.aid
+            message.reshared_user_id = original.uid
+        else:
+            message = user.post_message()
+        message.time = i * 0.01
+        messages.append(message)
+    return messages
+
+
+def bench_init_network(net_size: int):
+    def run():
+        simtools.init_network(net_size=net_size, p=0.5, k_out=3, seed=SEED)
+
+    return run
+
+
+def bench_make_actions(feed_size: int, post_per_day: int):
+    user = simtools.init_network(net_size=100, p=0.5, k_out=3, seed=SEED)[0]
+    user.post_per_day = post_per_day
+    feed = make_messages(feed_size)
+
+    def run():
+        user.newsfeed = list(feed)
+        user.make_actions()
+
+    return run
+
+
+def bench_activate(
+    feed_size: int, post_per_day: int, n_users: int, view_recording: str, action_engine: str
+):
+    """Activate a batch of users and record their views, as an agent handler does"""
+    users = simtools.init_network(net_size=100, p=0.5, k_out=3, seed=SEED)[:n_users]
+    for user in users:
+        user.post_per_day = post_per_day
+    feed = make_messages(feed_size)
+    rng = np.random.default_rng(SEED)
+
+    def run():
+        for user in users:
+            user.newsfeed = list(feed)
+        if action_engine == "numpy":
+            make_actions_batch(users, rng, view_recording=view_recording)
+        else:
+            for user in users:
+                _, passive_actions = user.make_actions()
+                record_views(passive_actions, view_recording, rng=rng)
+
+    return run
+
+
+def bench_cosine_similarity(n_pairs: int):
+    user_topics = simtools.init_network(net_size=100, p=0.5, k_out=3, seed=SEED)[0]
+    user_topics = user_topics.user_topics.tolist()
+    topics = [message.topics for message in make_messages(n_pairs)]
+
+    def run():
+        for message_topics in topics:
+            calculate_cosine_similarity(user_topics, message_topics)
+
+    return run
+
+
+def feed_candidates(n_in: int, n_out: int) -> tuple:
+    """
+    A user and the candidates of its feed: n_in messages of its friends and n_out of
+    the other users (n_in + n_out must be a multiple of 100)
+
+    Returns:
+        tuple: the user and the messages
+    """
+    user = simtools.init_network(net_size=100, p=0.5, k_out=3, seed=SEED)[0]
+    messages = make_messages(n_in + n_out, n_reshared=(n_in + n_out) // 4)
+    # make_messages cycles over the 100 users, the first ones are the friends
+    n_friends = 100 * n_in // (n_in + n_out)
+    user.friends = np.array([message.uid for message in messages[:n_friends]])
+    return user, messages
+
+
+def bench_build_feed(n_in: int, n_out: int):
+    user, messages = feed_candidates(n_in, n_out)
+    friends = set(user.friends.tolist())
+    in_messages = [message for message in messages if message.uid in friends]
+    out_messages = [message for message in messages if message.uid not in friends]
+
+    def run():
+        build_feed(user, in_messages, out_messages)
+
+    return run
+
+
+def bench_build_feed_numpy(n_in: int, n_out: int):
+    """Score the user and build its feed from the inventory (numpy ranking engine)"""
+    user, messages = feed_candidates(n_in, n_out)
+    inventory = MessageInventory(capacity=len(messages))
+    inventory.extend(messages)
+    ranker = VectorRanker(inventory)
+
+    def run():
+        build_feed_from_scores(user, inventory, ranker.score([user])[0])
+
+    return run
+
+
+def bench_clean_feed(feed_size: int):
+    feed = make_messages(feed_size, n_reshared=feed_size // 2)
+
+    def run():
+        clean_feed(feed, 15)
+
+    return run
+
+
+def bench_clean_feed_slots(feed_size: int):
+    inventory = MessageInventory(capacity=feed_size)
+    inventory.extend(make_messages(feed_size, n_reshared=feed_size // 2))
+    slots = inventory.slots()
+
+    def run():
+        clean_feed_slots(inventory, slots, 15)
+
+    return run
+
+
+def bench_inventory_extend(n_messages: int):
+    """Append a batch of messages to a full inventory, evicting as many"""
+    messages = make_messages(n_messages)
+    inventory = MessageInventory(capacity=n_messages)
+    inventory.extend(messages)
+
+    def run():
+        inventory.extend(messages)
+
+    return run
+
+
+def bench_split_by_authors(n_messages: int):
+    user = simtools.init_network(net_size=100, p=0.5, k_out=3, seed=SEED)[0]
+    inventory = MessageInventory(capacity=n_messages)
+    inventory.extend(make_messages(n_messages))
+
+    def run():
+        inventory.split_by_authors(user.friends)
+
+    return run
+
+
+def bench_transport(n_users: int, transport: str):
+    """Pack and unpack a batch of the data manager (USER_BATCH), as each transport does"""
+    users = simtools.init_network(net_size=100, p=0.5, k_out=3, seed=SEED)[:n_users]
+    feed = make_messages(15)
+    entries = []
+    for user in users:
+        user.newsfeed = list(feed)
+        new_msgs, passive_actions = user.make_actions()
+        entries.append((Activation.from_user(user), new_msgs, passive_actions))
+
+    def run():
+        if transport == "buffer":
+            unpack(pack(USER_BATCH, entries))
+        else:
+            pickle.loads(pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL))
+
+    return run
+
+
+def bench_custom_beta_quality(n_draws: int):
+    message = make_messages(1)[0]
+
+    def run():
+        for _ in range(n_draws):
+            message.custom_beta_quality(QUALITY_PARAMS)
+
+    return run
+
+
+def bench_write_output(n_users: int, output_format: str, view_recording: str = "full"):
+    """Write the actions of n_users activations, as the analyzer does for each batch"""
+    folder = tempfile.TemporaryDirectory()
+    writer = open_output(
+        os.path.join(folder.name, "activities.csv"),
+        os.path.join(folder.name, "passivities.csv"),
+        view_recording=view_recording,
+        output_format=output_format,
+    )
+    users = simtools.init_network(net_size=n_users, p=0.5, k_out=3, seed=SEED)
+    feed = make_messages(15)
+    rng = np.random.default_rng(SEED)
+    activities, passivities = [], []
+    for user in users:
+        user.newsfeed = list(feed)
+        new_msgs, passive_actions = user.make_actions()
+        activities.extend(new_msgs)
+        passivities.extend(record_views(passive_actions, view_recording, rng=rng))
+
+    def run():
+        writer.write("activity", activities)
+        writer.write("passivity", passivities)
+
+    def close():
+        writer.close()
+        folder.cleanup()
+
+    return run, close
+
+
+# name -> (setup, kwargs, number of calls per round)
+CASES = {
+    **{
+        f"init_network[n={n}]": (bench_init_network, {"net_size": n}, 1)
+        for n in (200, 1000, 5000)
+    },
+    **{
+        f"make_actions[feed={feed},ppd={ppd}]": (
+            bench_make_actions,
+            {"feed_size": feed, "post_per_day": ppd},
+            200,
+        )
+        for feed in (0, 15, 100)
+        for ppd in (1, 5)
+    },
+    # Reference (User.make_actions) and numpy action engine, with each view recording
+    **{
+        f"{name}[feed=100,ppd=5,users=10,views={view_recording}]": (
+            bench_activate,
+            {
+                "feed_size": 100,
+                "post_per_day": 5,
+                "n_users": 10,
+                "view_recording": view_recording,
+                "action_engine": action_engine,
+            },
+            1,
+        )
+        for view_recording in VIEW_RECORDINGS
+        for name, action_engine in (("make_actions", "counter"), ("make_actions_batch", "numpy"))
+    },
+    "cosine_similarity[n=1000]": (bench_cosine_similarity, {"n_pairs": 1000}, 5),
+    **{
+        f"{name}[in={n_in},out={n_out}]": (setup, {"n_in": n_in, "n_out": n_out}, 5)
+        for n_in, n_out in ((50, 50), (500, 1500))
+        for name, setup in (("build_feed", bench_build_feed), ("build_feed_numpy", bench_build_feed_numpy))
+    },
+    **{
+        f"{name}[n={n}]": (setup, {"feed_size": n}, 20)
+        for n in (100, 1000)
+        for name, setup in (("clean_feed", bench_clean_feed), ("clean_feed_slots", bench_clean_feed_slots))
+    },
+    "inventory_extend[n=1000]": (bench_inventory_extend, {"n_messages": 1000}, 5),
+    "split_by_authors[n=2000]": (bench_split_by_authors, {"n_messages": 2000}, 20),
+    **{
+        f"transport[{transport},users=10]": (
+            bench_transport,
+            {"n_users": 10, "transport": transport},
+            20,
+        )
+        for transport in ("pickle", "buffer")
+    },
+    "custom_beta_quality[n=10000]": (bench_custom_beta_quality, {"n_draws": 10000}, 5),
+    **{
+        f"write_output[{output_format},users=100]": (
+            bench_write_output,
+            {"n_users": 100, "output_format": output_format},
+            5,
+        )
+        for output_format in ("csv", "npz")
+    },
+    **{
+        f"write_output[csv,users=100,views={view_recording}]": (
+            bench_write_output,
+            {"n_users": 100, "output_format": "csv", "view_recording": view_recording},
+            5,
+        )
+        for view_recording in VIEW_RECORDINGS
+        if view_recording != "full"
+    },
+}
+
+
+def prepare_case(setup, kwargs: dict, number: int) -> tuple:
+    """
+    Set up a case and warm it up
+
+    Args:
+        setup (callable): returns the function to time (or the function and its cleanup)
+        kwargs (dict): params of setup
+        number (int): min number of calls per round (see MIN_ROUND)
+
+    Returns:
+        tuple: function to time, its cleanup (or None) and number of calls per round
+    """
+    seed_all()
+    run = setup(**kwargs)
+    close = None
+    if isinstance(run, tuple):
+        run, close = run
+    # Warm up the caches (e.g. the tables of the quality sampler)
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    if elapsed * number < MIN_ROUND:
+        number = math.ceil(MIN_ROUND / max(elapsed, 1e-7))
+    return run, close, number
+
+
+def time_round(run, number: int) -> float:
+    """Seconds per call of a round of number calls"""
+    start = time.perf_counter()
+    for _ in range(number):
+        run()
+    return (time.perf_counter() - start) / number
+
+
+def run_benchmarks(output: str, repeat: int, pattern: str = None) -> dict:
+    """Run the cases whose name contains pattern and write the results to output"""
+    cases = {
+        name: prepare_case(setup, kwargs, number)
+        for name, (setup, kwargs, number) in CASES.items()
+        if not pattern or pattern in name
+    }
+    # The rounds of the cases are interleaved, so that a slow period of the machine
+    # slows down a round of every case instead of all the rounds of a few cases
+    timings = {name: [] for name in cases}
+    # As timeit, keep the collections of the garbage collector out of the timings
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            for name, (run, _, number) in cases.items():
+                timings[name].append(time_round(run, number))
+    finally:
+        gc.enable()
+
+    results = {}
+    for name, (_, close, number) in cases.items():
+        if close is not None:
+            close()
+        results[name] = {
+            "median": statistics.median(timings[name]),
+            "min": min(timings[name]),
+            "mean": statistics.fmean(timings[name]),
+            "number": number,
+            "repeat": repeat,
+        }
+        print(f"{name:<62} {results[name]['min'] * 1e3:12.4f} ms", flush=True)
+    report = {
+        "meta": {
+            "seed": SEED,
+            "time": int(time.time()),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "node": platform.node(),
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+def compare(baseline: dict, current: dict, threshold: float, min_delta: float = 0.0) -> list:
+    """
+    Compare the min of the cases in both results
+
+    Args:
+        baseline (dict): results of the baseline (see run_benchmarks)
+        current (dict): results to check
+        threshold (float): relative slowdown that counts as a regression
+        min_delta (float): seconds per call below which a change is noise
+
+    Returns:
+        list: names of the regressed cases
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            print(f"{name:<62} {'':>12} {result['min'] * 1e3:12.4f} ms   new")
+            continue
+        ratio = result["min"] / reference["min"]
+        if abs(result["min"] - reference["min"]) <= min_delta:
+            verdict = "ok"
+        elif ratio > 1 + threshold:
+            regressions.append(name)
+            verdict = "REGRESSION"
+        elif ratio < 1 / (1 + threshold):
+            verdict = "faster"
+        else:
+            verdict = "ok"
+        print(
+            f"{name:<62} {reference['min'] * 1e3:12.4f} {result['min'] * 1e3:12.4f} ms"
+            f" {ratio:6.2f}x  {verdict}"
+        )
+    for name in sorted(baseline["results"].keys() - current["results"].keys()):
+        print(f"{name:<62} missing from the current results")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the simulation kernels")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--output", type=str, default=None, help="JSON file of the results")
+    run_parser.add_argument("--repeat", type=int, default=10, help="Number of rounds per case")
+    run_parser.add_argument("--filter", type=str, default=None, help="Only run the cases whose name contains this")
+    compare_parser = commands.add_parser("compare", help="Flag regressions against a baseline")
+    compare_parser.add_argument("baseline", type=str, help="JSON results of the baseline")
+    compare_parser.add_argument("current", type=str, help="JSON results to check")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Relative slowdown that counts as a regression"
+    )
+    compare_parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=1e-5,
+        help="Seconds per call below which a change is noise (for the fastest cases)",
+    )
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_benchmarks(args.output, args.repeat, args.filter)
+        return
+    with open(args.baseline, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+    with open(args.current, "r", encoding="utf-8") as file:
+        current = json.load(file)
+    regressions = compare(baseline, current, args.threshold, args.min_delta)
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Statistics used by the analyzer to check the convergence of the simulation.
+They are updated batch by batch in constant memory, whatever the length of the run:
+running moments of the qualities (mean and variance, merged with the batch update of
+Welford's algorithm) and per-user counters of the actions in preallocated arrays.
+With convergence_source = "reduce" the agent handlers keep partial aggregates of the
+messages they produce, and the analyzer combines them with non-blocking reductions
+(see PartialAggregates) instead of reading the stream of actions.
+"""
+
+import numpy as np
+from mpi4py import MPI
+from action import VIEW, aid_kind, aid_uid, aid_counter
+
+# Fields of the partial aggregates
+N_ACTIVATIONS, N_MESSAGES, QUALITY_SUM, QUALITY_SQUARES, FINAL = range(5)
+
+
+class RunningStats:
+    """Count, mean and variance of a stream of values"""
+
+    __slots__ = ("count", "mean", "m2")
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.count = 0
+        self.mean = 0.0
+        # Sum of the squared differences from the mean
+        self.m2 = 0.0
+
+    @classmethod
+    def from_values(cls, values):
+        """Moments of a batch of values (list or np.ndarray)"""
+        stats = cls()
+        values = np.asarray(values, dtype=np.float64)
+        if len(values):
+            stats.count = len(values)
+            stats.mean = values.mean()
+            stats.m2 = np.square(values - stats.mean).sum()
+        return stats
+
+    @classmethod
+    def from_sums(cls, count: int, total: float, squares: float):
+        """Moments of a batch of values from their count, sum and sum of squares"""
+        stats = cls()
+        if count:
+            stats.count = int(count)
+            stats.mean = total / count
+            stats.m2 = max(squares - total * stats.mean, 0.0)
+        return stats
+
+    def merge(self, other) -> None:
+        """Add the values of another RunningStats (Chan et al. update of the moments)"""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    def update(self, values) -> None:
+        """Add a batch of values
+
+        Args:
+            values: values of the batch (list or np.ndarray)
+        """
+        self.merge(RunningStats.from_values(values))
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / self.count if self.count else 0.0
+
+
+class ActionCounters:
+    """Number of posts, reshares and views of each user, indexed by uid"""
+
+    def __init__(self, n_users: int) -> None:
+        # (3, n_users), rows follow the kinds of action (action.POST, RESHARE and VIEW)
+        self.limits = np.zeros((3, n_users), dtype=np.int64)
+
+    def update(self, activations: list, aids: np.ndarray) -> None:
+        """Count the actions of a batch
+
+        Args:
+            activations (list): activations of the batch, with the counters of the views
+            aids (np.ndarray): ids of the messages of the batch
+        """
+        np.maximum.at(
+            self.limits, (aid_kind(aids), aid_uid(aids)), aid_counter(aids) + 1
+        )
+        for activation in activations:
+            self.limits[VIEW, activation.uid] = max(
+                self.limits[VIEW, activation.uid], activation.view_counter
+            )
+
+
+class PartialAggregates:
+    """
+    Number of activations, number of messages and sums of the qualities of the messages
+    produced by the agent handlers, combined in rounds of non-blocking Iallreduce on a
+    communicator of the analyzer and the agent handlers.
+    Each agent handler joins a new round with its running totals as soon as the previous
+    round completed, the analyzer joins with zeros and reads the totals of every round.
+    The analyzer marks the last round as final, so that everyone stops at the same round.
+    """
+
+    def __init__(self, comm: MPI.Intracomm) -> None:
+        self.comm = comm
+        self.totals = np.zeros(5)
+        # Buffers of the pending round
+        self.sent = None
+        self.result = np.zeros(5)
+        self.request = None
+        self.final = False
+
+    @classmethod
+    def create(cls, comm_world: MPI.Intercomm, rank_index: dict):
+        """Create the communicator of the reductions (collective over its members)"""
+        members = [rank_index["analyzer"]] + list(
+            range(rank_index["agent_handler"], comm_world.Get_size())
+        )
+        return cls(comm_world.Create_group(comm_world.Get_group().Incl(members)))
+
+    def add(self, n_activations: int, qualities) -> None:
+        """Add the messages of a batch of activations to the totals"""
+        qualities = np.asarray(qualities, dtype=np.float64)
+        self.totals[N_ACTIVATIONS] += n_activations
+        self.totals[N_MESSAGES] += len(qualities)
+        self.totals[QUALITY_SUM] += qualities.sum()
+        self.totals[QUALITY_SQUARES] += np.square(qualities).sum()
+
+    def start(self, final: bool = False) -> None:
+        """Join a new round with the current totals"""
+        self.sent = self.totals.copy()
+        self.sent[FINAL] = final
+        self.request = self.comm.Iallreduce(self.sent, self.result, op=MPI.SUM)
+
+    def poll(self) -> bool:
+        """Check if the pending round completed
+
+        Returns:
+            bool: True if there is no pending round (result holds the last totals)
+        """
+        if self.request is not None and self.request.Test():
+            self.request = None
+            self.final = self.result[FINAL] > 0
+        return self.request is None
+
+    def wait(self) -> None:
+        if self.request is not None:
+            self.request.Wait()
+            self.request = None
+            self.final = self.result[FINAL] > 0
+
+    def contribute(self) -> None:
+        """Join a new round if the previous one completed (agent handlers)"""
+        if self.poll() and not self.final:
+            self.start()
+
+    def close(self, final: bool = False) -> None:
+        """Take part in the rounds up to the final one and free the communicator
+
+        Args:
+            final (bool): start the final round (analyzer)
+        """
+        if final:
+            self.wait()
+            self.start(final=True)
+        self.wait()
+        while not self.final:
+            self.start()
+            self.wait()
+        self.comm.Free()
@@ -9,7 +9,11 @@ import copy
 import numpy as np
 import pandas as pd
 from mpi4py import MPI
-from user import User
+from user import User, Activation
+from simtools import user_shard
+from transport import make_transport, USER_BATCH, WRITER_BATCH
+from writer_process import assigned_writer
+from instrumentation import PROFILER
 
 class ClockManager:
     """
@@ -39,6 +43,8 @@ def run_data_manager(
     size: int,
     rank_index: dict,
     batch_size=5,
+    user_transfer: str = "object",
+    transport: str = "pickle",
 ):
 
     # Verbose: use flush=True to print messages
@@ -46,7 +52,13 @@ def run_data_manager(
 
     # Arch status object
     status = MPI.Status()
+
+    # Pickled objects or packed buffers
+    channel = make_transport(comm_world, transport)
     
+    # Authoritative state of the users (updated with the activations in delta mode)
+    users_by_uid = {user.uid: user for user in users}
+
     # Outgoing messages
     outgoing_messages = {user.uid: [] for user in users}
     outgoing_passivities = {user.uid: [] for user in users}
@@ -54,8 +66,20 @@ def run_data_manager(
     # Clock
     clock = ClockManager()
 
+    # Users are sharded across the recommender systems, each shard has its own round-robin
+    recsys_ranks = rank_index["recommender_system"]
+    shard_users = {
+        recsys_rank: [
+            user for user in users if user_shard(user.uid, len(recsys_ranks)) == shard
+        ]
+        for shard, recsys_rank in enumerate(recsys_ranks)
+    }
+
     # Manage user selection
-    selected_users = set() 
+    shard_selected_users = {recsys_rank: set() for recsys_rank in recsys_ranks}
+
+    # Number of agent handlers that sent the termination signal
+    n_closed = 0
 
     # Bootstrap sync
     comm_world.Barrier()
@@ -65,33 +89,49 @@ def run_data_manager(
 
     while True:
 
-        data = comm_world.recv(source=MPI.ANY_SOURCE, status=status)        
+        with PROFILER.phase("recv"):
+            data = channel.recv(source=MPI.ANY_SOURCE, status=status)
         msg, content = data
 
         if msg == "ping_agent_pool_manager":
-            # Unpack the agent + incoming messages and passive actions
-            user, new_msgs, passive_actions = content
-            for msg in new_msgs:
-                msg.time = clock.next_time()   
-            # print(f"- Data manager >> {user.uid} has {len(new_msgs)} new messages", flush=True)
-            # print(f"- Data manager >> {user.uid} has {len(passive_actions)} new passivities", flush=True)
-            
-            # TODO: FIX THIS DEADPOINT, if we uncomment this we have a deadpoint
-            outgoing_messages[user.uid].extend(new_msgs)
-            outgoing_passivities[user.uid].extend(passive_actions)
+            # Unpack the agents of the batch + incoming messages and passive actions
+            stamped = []
+            for user, new_msgs, passive_actions in content:
+                if user_transfer == "delta":
+                    user = user.apply(users_by_uid[user.uid])
+                for msg in new_msgs:
+                    msg.time = clock.next_time()   
+                # print(f"- Data manager >> {user.uid} has {len(new_msgs)} new messages", flush=True)
+                # print(f"- Data manager >> {user.uid} has {len(passive_actions)} new passivities", flush=True)
+                
+                # TODO: FIX THIS DEADPOINT, if we uncomment this we have a deadpoint
+                outgoing_messages[user.uid].extend(new_msgs)
+                outgoing_passivities[user.uid].extend(passive_actions)
+                stamped.append((Activation.from_user(user), new_msgs, []))
+            if rank_index["writer"]:
+                # The writer of the agent handler persists the messages with their time
+                with PROFILER.phase("send_writer"):
+                    channel.send(
+                        stamped,
+                        dest=assigned_writer(status.Get_source(), rank_index),
+                        kind=WRITER_BATCH,
+                    )
             # print(len(outgoing_passivities[user.uid]))
 
         elif msg == "ping_recsys":
-            # Unpicked agents count
-            
+            # Pick the users of the shard owned by the recommender system that sent the ping
+            recsys_rank = status.Get_source()
+            users = shard_users[recsys_rank]
+            selected_users = shard_selected_users[recsys_rank]
+
             users_packs_batch = []
             
             # Since we risk to shuffle the users when we build the batch, we need to
             # make sure we don't pick the same user twice
-            batch_size = min(batch_size, len(users) - len(selected_users))
+            n_picks = min(batch_size, len(users) - len(selected_users))
 
             # Build the batch
-            for _ in range(batch_size):
+            for _ in range(n_picks):
                 # Always pick the first user (round-robin style)
                 picked_user = users[0]
             
@@ -99,13 +139,15 @@ def run_data_manager(
                 selected_users.add(picked_user.uid)
 
                 # Move picked user to the end of the list
-                users = users[1:] + [picked_user]
+                users.append(users.pop(0))
                 
                 # Get the in and out messages based on friends
                 active_actions_send = outgoing_messages[picked_user.uid]
                 passive_actions_send = outgoing_passivities[picked_user.uid]
 
                 # Add it to the batch
+                if user_transfer == "delta":
+                    picked_user = Activation.from_user(picked_user)
                 users_packs_batch.append((picked_user, active_actions_send, passive_actions_send))
                 
                 # TODO: Flush outgoing messages ????
@@ -117,18 +159,27 @@ def run_data_manager(
                     rnd.shuffle(users)
                     selected_users.clear()
                 
-            comm_world.send(users_packs_batch, dest=rank_index["recommender_system"])
+            PROFILER.count("batch_size", len(users_packs_batch))
+            with PROFILER.phase("send"):
+                channel.send(users_packs_batch, dest=recsys_rank, kind=USER_BATCH)
 
         elif msg == "ping_policy":
             continue
             # print("- Data manager >> ping policy")
 
         elif msg == "sigterm":
+            # Keep receiving until all the agent handlers are closed
+            n_closed += 1
+            if n_closed < size - rank_index["agent_handler"]:
+                continue
             # print("- Data manager >> termination signal, stopping simulation...")
+            # Nothing else will be forwarded to the writers
+            for writer_rank in rank_index["writer"]:
+                comm_world.send("sigterm", dest=writer_rank)
 
             # Flush pending incoming messages
             while comm_world.Iprobe(source=MPI.ANY_SOURCE, status=status):
-                _ = comm_world.recv(source=MPI.ANY_SOURCE, status=status)
+                _ = channel.recv(source=MPI.ANY_SOURCE, status=status)
             comm_world.Barrier()
             break
     # print("- Data manager >> finished", flush=True)
\ No newline at end of file
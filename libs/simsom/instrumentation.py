@@ -0,0 +1,173 @@
+"""
+Timers and counters of the hot paths of each role (receive, compute and send phases).
+Every module records on the PROFILER of its rank:
+    with PROFILER.phase("recv"):
+        data = channel.recv(...)
+    PROFILER.count("batch_size", len(data))
+The profiler is disabled unless the simulator config sets "profile": phase() then
+returns a shared no-op context and count() returns immediately.
+At termination the profiles of all the ranks are gathered by the analyzer, which writes
+one JSON summary per rank (profile-r<rank>.json) and a merged timeline in the Chrome
+trace format (trace.json), that can be opened with chrome://tracing or Perfetto.
+"""
+
+import os
+import json
+import time
+from contextlib import nullcontext
+
+# Shared no-op context of the disabled profiler
+NO_PHASE = nullcontext()
+
+
+class Phase:
+    """Context manager that times a phase and records it on the profiler"""
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start)
+
+
+class Profiler:
+    """Named timers, counters and timeline of a rank"""
+
+    def __init__(self) -> None:
+        self.configure(rank=0, role="", enabled=False)
+
+    def configure(self, rank: int, role: str, enabled: bool, max_events: int = 100000) -> None:
+        """
+        Set the rank and the role of the process and enable the profiler
+
+        Args:
+            rank (int): rank of the process
+            role (str): role of the process (see simsom.build_rank_index)
+            enabled (bool): record timers and counters
+            max_events (int): max number of phases kept for the timeline
+                (the timers keep counting after that)
+        """
+        self.rank = rank
+        self.role = role
+        self.enabled = enabled
+        self.max_events = max_events
+        # name -> [n. of calls, total seconds, max seconds]
+        self.timers = {}
+        # name -> [n. of values, sum of the values]
+        self.counters = {}
+        # (name, start, duration), start relative to the origin
+        self.events = []
+        # Wall clock of the origin of perf_counter, to align the timelines of the ranks
+        self.origin = time.time() - time.perf_counter()
+
+    def phase(self, name: str):
+        """Context manager that times the phase name"""
+        if not self.enabled:
+            return NO_PHASE
+        return Phase(self, name)
+
+    def record(self, name: str, start: float, duration: float) -> None:
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += duration
+        timer[2] = max(timer[2], duration)
+        if len(self.events) < self.max_events:
+            self.events.append((name, start, duration))
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Add value to the counter name (e.g. the size of a batch)"""
+        if not self.enabled:
+            return
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = [0, 0]
+        counter[0] += 1
+        counter[1] += value
+
+    def summary(self) -> dict:
+        """Timers, counters and timeline of the rank (JSON serializable)"""
+        return {
+            "rank": self.rank,
+            "role": self.role,
+            "timers": {
+                name: {"calls": calls, "total": total, "max": longest}
+                for name, (calls, total, longest) in self.timers.items()
+            },
+            "counters": {
+                name: {"n": n, "sum": total, "mean": total / n if n else 0.0}
+                for name, (n, total) in self.counters.items()
+            },
+            "events": [
+                (name, self.origin + start, duration)
+                for name, start, duration in self.events
+            ],
+        }
+
+
+def chrome_trace(profiles: list) -> dict:
+    """
+    Merge the profiles of the ranks in a timeline of the Chrome trace format,
+    with one thread per rank and times in microseconds from the first phase
+
+    Args:
+        profiles (list): summaries of the ranks (see Profiler.summary)
+
+    Returns:
+        dict: trace, ready to be dumped as JSON
+    """
+    starts = [start for profile in profiles for _, start, _ in profile["events"]]
+    origin = min(starts) if starts else 0.0
+    trace_events = []
+    for profile in profiles:
+        trace_events.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 0,
+                "tid": profile["rank"],
+                "args": {"name": f"{profile['rank']} {profile['role']}"},
+            }
+        )
+        trace_events.extend(
+            {
+                "name": name,
+                "cat": profile["role"],
+                "ph": "X",
+                "pid": 0,
+                "tid": profile["rank"],
+                "ts": (start - origin) * 1e6,
+                "dur": duration * 1e6,
+            }
+            for name, start, duration in profile["events"]
+        )
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def write_profiles(folder: str, profiles: list) -> None:
+    """
+    Write the summary of each rank and the merged timeline
+
+    Args:
+        folder (str): output folder of the simulation
+        profiles (list): summaries of the ranks (see Profiler.summary)
+    """
+    os.makedirs(folder, exist_ok=True)
+    for profile in profiles:
+        summary = {key: value for key, value in profile.items() if key != "events"}
+        with open(os.path.join(folder, f"profile-r{profile['rank']}.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+    with open(os.path.join(folder, "trace.json"), "w") as f:
+        json.dump(chrome_trace(profiles), f)
+
+
+# Profiler of this process (see simsom.py)
+PROFILER = Profiler()
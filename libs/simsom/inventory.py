@@ -0,0 +1,148 @@
+"""
+Inventory of the messages known by the recommender system.
+Messages are stored column-wise in a fixed-capacity ring buffer, so appending and
+evicting are O(1) and the recommender can rank messages working on array slices.
+Messages are also indexed by author so that the in-network candidates of a user
+are gathered from the buckets of their friends instead of scanning the whole inventory.
+"""
+
+from collections import defaultdict, deque
+import numpy as np
+from ranking import N_TOPICS, normalize_rows
+
+
+class MessageInventory:
+    """
+    Fixed-capacity ring buffer of messages (struct of arrays).
+    Every message gets a sequence number when appended; the slot of a message is
+    its sequence number modulo the capacity. The author index stores sequence numbers,
+    so evicting the oldest messages only requires to pop from the front of the buckets.
+
+    Messages are evicted (oldest first) when:
+        - the inventory is full (capacity)
+        - the oldest message is older than ttl clock time units with respect to the
+          newest message seen (if ttl is set)
+    Messages are not appended in time order (the data manager holds the messages of a
+    user until the user is picked, and shards replicate them later), so expired messages
+    can stay behind a newer oldest message: they are left out of the candidates returned
+    by split_by_authors until they are evicted.
+    If max_bytes is set, the capacity is reduced so that the columns fit in the budget.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 2000,
+        ttl: float = None,
+        max_bytes: int = None,
+        n_topics: int = N_TOPICS,
+    ) -> None:
+        self.ttl = ttl
+        self.n_topics = n_topics
+        if max_bytes:
+            capacity = min(capacity, max(1, max_bytes // self.row_bytes(n_topics)))
+        self.capacity = capacity
+
+        # Columns
+        self.mid = np.zeros(capacity, dtype=np.int64)
+        self.author = np.zeros(capacity, dtype=np.int64)
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.quality = np.zeros(capacity, dtype=np.float32)
+        self.appeal = np.zeros(capacity, dtype=np.float32)
+        self.reshared_original_id = np.zeros(capacity, dtype=np.int64)
+        self.topics = np.zeros((capacity, n_topics), dtype=np.float32)  # unit-normalized
+        self.message = np.empty(capacity, dtype=object)
+
+        self.first_seq = 0  # sequence number of the oldest message
+        self.next_seq = 0  # sequence number of the next message
+        self.newest_time = -np.inf
+        self.authors = defaultdict(deque)
+
+    @staticmethod
+    def row_bytes(n_topics: int = N_TOPICS) -> int:
+        """Bytes used by one message in the columns (object columns count as references)"""
+        return 5 * 8 + 2 * 4 + n_topics * 4
+
+    def __len__(self) -> int:
+        return self.next_seq - self.first_seq
+
+    def __getitem__(self, slot: int):
+        return self.message[slot]
+
+    def __iter__(self):
+        return iter(self.message[self.slots()])
+
+    def extend(self, messages: list) -> None:
+        """Append new messages to the inventory, evicting the oldest if needed
+
+        Args:
+            messages (list): messages to append
+        """
+        if not messages:
+            return
+        for message in messages:
+            if len(self) == self.capacity:
+                self._evict_oldest()
+            slot = self.next_seq % self.capacity
+            self.mid[slot] = message.aid
+            self.author[slot] = message.uid
+            self.time[slot] = message.time
+            self.quality[slot] = message.quality
+            self.appeal[slot] = message.appeal
+            self.reshared_original_id[slot] = message.reshared_original_id
+            self.message[slot] = message
+            self.authors[message.uid].append(self.next_seq)
+            self.newest_time = max(self.newest_time, message.time)
+            self.next_seq += 1
+        new_slots = self.slots()[-len(messages) :]
+        self.topics[new_slots] = normalize_rows([m.topics for m in messages])[
+            -len(new_slots) :
+        ]
+        if self.ttl is not None:
+            while len(self) and self.time[self.first_seq % self.capacity] < (
+                self.newest_time - self.ttl
+            ):
+                self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        slot = self.first_seq % self.capacity
+        author = int(self.author[slot])
+        bucket = self.authors[author]
+        bucket.popleft()
+        if not bucket:
+            del self.authors[author]
+        self.message[slot] = None
+        self.first_seq += 1
+
+    def slots(self) -> np.ndarray:
+        """Slots of the messages in the inventory, oldest first"""
+        return np.arange(self.first_seq, self.next_seq) % self.capacity
+
+    def split_by_authors(self, authors) -> tuple:
+        """Split the inventory into messages posted by the given authors and the rest
+
+        Args:
+            authors (np.ndarray): uids of the authors (e.g. the friends of a user)
+
+        Returns:
+            tuple: slots of the in-network and of the out-of-network messages, oldest first
+        """
+        in_seq = np.sort(
+            np.fromiter(
+                (
+                    seq
+                    for author in np.unique(authors).tolist()
+                    for seq in self.authors.get(author, ())
+                ),
+                dtype=np.int64,
+            )
+        )
+        is_in = np.zeros(len(self), dtype=bool)
+        is_in[in_seq - self.first_seq] = True
+        all_slots = self.slots()
+        return self._unexpired(in_seq % self.capacity), self._unexpired(all_slots[~is_in])
+
+    def _unexpired(self, slots: np.ndarray) -> np.ndarray:
+        """Drop the slots of the messages older than ttl (if ttl is set)"""
+        if self.ttl is None:
+            return slots
+        return slots[self.time[slots] >= self.newest_time - self.ttl]
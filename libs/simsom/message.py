@@ -6,10 +6,36 @@ Messages are object used in the users.py as vector of contents.
 
 import random
 import numpy as np
-from action import Action
+from action import Action, NO_ID, format_aid, format_uid
+from quality import QUALITY_SAMPLER
+
+# Columns of the activity file (see Message.write_action)
+ACTIVITY_COLUMNS = [
+    "message_id",
+    "user_id",
+    "quality",
+    "appeal",
+    "reshared_id",
+    "reshared_user_id",
+    "reshared_original_id",
+    "clock_time",
+]
 
 
 class Message(Action):
+    __slots__ = (
+        "quality_params",
+        "topics",
+        "is_shadow",
+        "exposure",
+        "appeal",
+        "quality",
+        "time",
+        "reshared_id",
+        "reshared_original_id",
+        "reshared_user_id",
+    )
+
     def __init__(
         self,
         mid: int,
@@ -17,10 +43,11 @@ class Message(Action):
         quality_params: tuple,
         topics: list,
         is_shadow: bool,
-        exposure: list = [],
+        exposure: list = None,
     ) -> None:
         Action.__init__(self, mid, uid)
         self.quality_params = quality_params
+        # Reshares reference the topics (and exposure) of the original message
         self.topics = topics
         self.is_shadow = is_shadow
         self.exposure = exposure
@@ -30,9 +57,45 @@ class Message(Action):
         else:
             self.quality = None
         self.time = None
-        self.reshared_id = np.nan
-        self.reshared_original_id = np.nan
-        self.reshared_user_id = np.nan
+        self.reshared_id = NO_ID
+        self.reshared_original_id = NO_ID
+        self.reshared_user_id = NO_ID
+
+    @classmethod
+    def from_fields(
+        cls,
+        mid: int,
+        uid: int,
+        topics: list,
+        is_shadow: bool,
+        appeal: float,
+        quality: float,
+        quality_params: tuple = None,
+        exposure: list = None,
+        time: float = None,
+        reshared_id: int = NO_ID,
+        reshared_original_id: int = NO_ID,
+        reshared_user_id: int = NO_ID,
+    ):
+        """Create a message whose quality and appeal were already drawn
+        (e.g. by the vectorized action kernel or by the sender of a packed batch)
+
+        Returns:
+            Message: the message, no random value is drawn
+        """
+        message = cls.__new__(cls)
+        Action.__init__(message, mid, uid)
+        message.quality_params = quality_params
+        message.topics = topics
+        message.is_shadow = is_shadow
+        message.exposure = exposure
+        message.appeal = appeal
+        message.quality = quality
+        message.time = time
+        message.reshared_id = reshared_id
+        message.reshared_original_id = reshared_original_id
+        message.reshared_user_id = reshared_user_id
+        return message
 
     def expon_quality(self, lambda_quality=-5) -> float:
         """return a quality value x via inverse transform sampling
@@ -54,6 +117,8 @@ class Message(Action):
         which we want our values to come out.
         If, for example, values between 0 and 0.3 are set, then we discard values
         greater than 0.3 and take the first one that falls within the set range.
+        Values (rounded to 2 decimals) are drawn directly from the truncated distribution
+        by the sampler of the process, see quality.py.
 
         Args:
             distribution_param (tuple): tuple to define the value of
@@ -64,13 +129,7 @@ class Message(Action):
             float: quality value
         """
         if distribution_param:
-            alpha, beta, lower, upper = distribution_param
-            checked = False
-            while not checked:
-                quality = round(np.random.beta(alpha, beta), 2)
-                if quality >= lower and quality <= upper:
-                    checked = True
-            return quality
+            return QUALITY_SAMPLER.sample(tuple(distribution_param))
         else:
             return self.expon_quality()
 
@@ -116,12 +175,19 @@ class Message(Action):
             tuple: return the values that we want to keep on the disk
         """
         parent_values = super().write_action()
+        # Missing reshared fields are written as nan, as they used to be
+        if self.reshared_id == NO_ID:
+            reshared_values = (np.nan, np.nan, np.nan)
+        else:
+            reshared_values = (
+                format_aid(self.reshared_id),
+                format_uid(self.reshared_user_id),
+                format_aid(self.reshared_original_id),
+            )
         return (
             *parent_values,
             self.quality,
             self.appeal,
-            self.reshared_id,
-            self.reshared_user_id,
-            self.reshared_original_id,
+            *reshared_values,
             self.time,
         )
@@ -0,0 +1,371 @@
+"""
+Compact representation of the follower network.
+The network is stored as CSR arrays (friends and followers of each user) plus
+per-user attribute arrays, so that it can be built once and shared with all the
+processes of a node through an MPI-3 shared memory window.
+"""
+
+import os
+import ast
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from mpi4py import MPI
+from ranking import N_TOPICS
+from user import User
+
+USER_CLASSES = ("normal user", "lurker")
+
+# Bump when the arrays (or their meaning) change, to invalidate cached networks
+CACHE_VERSION = 1
+
+
+def generate_users_topics(
+    n_users: int, total_topics=N_TOPICS, min_active=5, max_active=15, rng=None
+) -> np.ndarray:
+    """Vectorized version of user.generate_user_topics for all the users at once
+
+    Args:
+        n_users (int): number of users
+        total_topics (int): number of topics. Defaults to N_TOPICS.
+        min_active (int): minimum number of topics the user is interested in
+        max_active (int): maximum number of topics the user is interested in
+        rng (np.random.Generator, optional): random generator. Defaults to None.
+
+    Returns:
+        np.ndarray: (n_users, total_topics) float32 matrix of interest levels
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    num_active = rng.integers(min_active, max_active, size=n_users, endpoint=True)
+    # A random permutation of the topics for each user, keep the first num_active
+    ranks = rng.random((n_users, total_topics)).argsort(axis=1).argsort(axis=1)
+    active = ranks < num_active[:, None]
+    return np.where(active, rng.random((n_users, total_topics)), 0).astype(np.float32)
+
+
+def _csr(sources: np.ndarray, targets: np.ndarray, n_users: int) -> tuple:
+    """Build CSR arrays (offsets, neighbors) from an edge list, neighbors sorted by id"""
+    order = np.lexsort((targets, sources))
+    offsets = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n_users), out=offsets[1:])
+    return offsets, targets[order].astype(np.int32)
+
+
+class Network:
+    """
+    Follower network in CSR format. The friends of user i (the users they follow) are
+    friends[friend_offsets[i] : friend_offsets[i + 1]], and followers are stored the same way.
+    User ids are the indices of the users.
+    """
+
+    # Arrays that make up the network (shared between processes)
+    ARRAYS = (
+        "friend_offsets",
+        "friends",
+        "follower_offsets",
+        "followers",
+        "user_class",
+        "post_per_day",
+        "quality_params",
+        "user_topics",
+    )
+
+    def __init__(
+        self,
+        friend_offsets: np.ndarray,
+        friends: np.ndarray,
+        follower_offsets: np.ndarray,
+        followers: np.ndarray,
+        user_class: np.ndarray,
+        post_per_day: np.ndarray,
+        quality_params: np.ndarray,
+        user_topics: np.ndarray,
+    ) -> None:
+        self.friend_offsets = friend_offsets
+        self.friends = friends
+        self.follower_offsets = follower_offsets
+        self.followers = followers
+        self.user_class = user_class
+        self.post_per_day = post_per_day
+        self.quality_params = quality_params
+        self.user_topics = user_topics
+        self.windows = []  # shared memory windows backing the arrays (if any)
+
+    @property
+    def n_users(self) -> int:
+        return len(self.friend_offsets) - 1
+
+    @classmethod
+    def from_edges(
+        cls,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        user_class: np.ndarray,
+        post_per_day: np.ndarray,
+        quality_params: np.ndarray,
+        user_topics: np.ndarray = None,
+        rng: np.random.Generator = None,
+    ):
+        """Build the network from the list of (follower, friend) edges and the attributes"""
+        n_users = len(post_per_day)
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        friend_offsets, friends = _csr(sources, targets, n_users)
+        follower_offsets, followers = _csr(targets, sources, n_users)
+        if user_topics is None:
+            user_topics = generate_users_topics(n_users, rng=rng)
+        return cls(
+            friend_offsets=friend_offsets,
+            friends=friends,
+            follower_offsets=follower_offsets,
+            followers=followers,
+            user_class=np.asarray(user_class, dtype=np.int8),
+            post_per_day=np.asarray(post_per_day, dtype=np.float64),
+            quality_params=np.asarray(quality_params, dtype=np.float64),
+            user_topics=np.asarray(user_topics, dtype=np.float32),
+        )
+
+    @classmethod
+    def from_graph(cls, graph, rng: np.random.Generator = None):
+        """Build the network from an igraph graph with the simtools.MINIMUM_REQUIRED_ATTRIBS"""
+        edges = np.array(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        # The distribution string is the same for most users, parse it once
+        parsed = {q: ast.literal_eval(q) for q in set(graph.vs["qualitydistr"])}
+        quality_params = [parsed[q] for q in graph.vs["qualitydistr"]]
+        return cls.from_edges(
+            sources=edges[:, 0],
+            targets=edges[:, 1],
+            user_class=[USER_CLASSES.index(utype) for utype in graph.vs["utype"]],
+            post_per_day=graph.vs["postperday"],
+            quality_params=quality_params,
+            rng=rng,
+        )
+
+    def user_friends(self, index: int) -> np.ndarray:
+        """Indices of the users followed by the user"""
+        return self.friends[self.friend_offsets[index] : self.friend_offsets[index + 1]]
+
+    def user_followers(self, index: int) -> np.ndarray:
+        """Indices of the users that follow the user"""
+        return self.followers[
+            self.follower_offsets[index] : self.follower_offsets[index + 1]
+        ]
+
+    def make_user(self, index: int) -> User:
+        """Create the User object of a user of the network (arrays are views of the network)"""
+        return User(
+            uid=index,
+            user_class=USER_CLASSES[self.user_class[index]],
+            post_per_day=int(self.post_per_day[index]),
+            quality_params=tuple(self.quality_params[index].tolist()),
+            friends=self.user_friends(index),
+            followers=self.user_followers(index),
+            user_topics=self.user_topics[index],
+        )
+
+    def to_users(self) -> list:
+        """Create the User objects of the network"""
+        return [self.make_user(index) for index in range(self.n_users)]
+
+
+def random_walk_network(
+    net_size: int = 200,
+    p: float = 0.5,
+    k_out: int = 3,
+    quality_params: tuple = (0.5, 0.15, 0, 1),
+    seed: int = None,
+) -> Network:
+    """
+    Vectorized version of simtools.init_graph (directed random-walk growth model).
+    Every new node n follows a target chosen uniformly among the previous nodes,
+    Binomial(k_out - 1, p) friends of the target and the rest uniformly among the previous nodes.
+
+    The friends of all the nodes are drawn at once into a preallocated (net_size, k_out)
+    matrix. A friend of a friend is stored as a pointer to the slot of the target's row it
+    copies; since targets always precede the node, pointers are resolved by pointer jumping.
+
+    Args:
+        net_size (int): number of nodes in the desired network
+        p (float): probability for a new node to follow friends of a friend
+        k_out (int): number of friends of each new node
+        quality_params (tuple): quality distribution params of every user
+        seed (int, optional): seed of the random generator. Defaults to None.
+
+    Returns:
+        Network: the generated network
+    """
+    rng = np.random.default_rng(seed)
+    n_clique = net_size if net_size <= k_out + 1 else k_out  # super small: just a clique
+
+    # Clique rows: every node follows all the other nodes of the clique
+    clique = np.arange(n_clique)
+    clique_friends = np.broadcast_to(clique, (n_clique, n_clique))[
+        ~np.eye(n_clique, dtype=bool)
+    ].reshape(n_clique, n_clique - 1)
+
+    width = max(k_out, n_clique - 1)
+    values = np.full((net_size, width), -1, dtype=np.int64)
+    values[:n_clique, : n_clique - 1] = clique_friends
+    degree = np.full(net_size, k_out, dtype=np.int64)
+    degree[:n_clique] = n_clique - 1
+    pointers = np.arange(net_size * width, dtype=np.int64).reshape(net_size, width)
+
+    nodes = np.arange(n_clique, net_size)
+    n_new = len(nodes)
+    if n_new:
+        # Target of each new node
+        targets = (rng.random(n_new) * nodes).astype(np.int64)
+        values[nodes, 0] = targets
+        # Friends of the target: distinct slots among the first degree[target] of its row
+        n_random_friends = rng.binomial(k_out - 1, p, size=n_new)
+        keys = rng.random((n_new, width))
+        keys[np.arange(width)[None, :] >= degree[targets][:, None]] = np.inf
+        columns = np.argsort(keys, axis=1)[:, : k_out - 1]
+        # Random friends: distinct nodes among the previous ones (redraw rows with duplicates)
+        randoms = (rng.random((n_new, k_out - 1)) * nodes[:, None]).astype(np.int64)
+        is_random = np.arange(k_out - 1)[None, :] >= n_random_friends[:, None]
+        while True:
+            masked = np.where(is_random, randoms, -1 - np.arange(k_out - 1))
+            masked.sort(axis=1)
+            redraw = np.flatnonzero((masked[:, 1:] == masked[:, :-1]).any(axis=1))
+            if len(redraw) == 0:
+                break
+            randoms[redraw] = (
+                rng.random((len(redraw), k_out - 1)) * nodes[redraw, None]
+            ).astype(np.int64)
+        values[nodes, 1:k_out] = np.where(is_random, randoms, -1)
+        pointers[nodes, 1:k_out] = np.where(
+            is_random,
+            pointers[nodes, 1:k_out],
+            targets[:, None] * width + columns,
+        )
+
+    # Resolve friends of friends by pointer jumping
+    pointers = pointers.ravel()
+    while True:
+        jumped = pointers[pointers]
+        if np.array_equal(jumped, pointers):
+            break
+        pointers = jumped
+    values = values.ravel()[pointers].reshape(net_size, width)
+
+    valid = np.arange(width)[None, :] < degree[:, None]
+    sources = np.broadcast_to(np.arange(net_size)[:, None], (net_size, width))[valid]
+    return Network.from_edges(
+        sources=sources,
+        targets=values[valid],
+        user_class=np.full(net_size, USER_CLASSES.index("normal user")),
+        post_per_day=rng.uniform(0, 50, size=net_size),
+        quality_params=np.broadcast_to(quality_params, (net_size, len(quality_params))),
+        rng=rng,
+    )
+
+
+def save_network(network: Network, folder: str, params: dict) -> None:
+    """Save the network arrays as .npy files (plus the params in params.json)
+
+    The files are written in a temporary folder which is then renamed, so a partially
+    written network is never visible to other runs.
+
+    Args:
+        network (Network): network to save
+        folder (str): destination folder
+        params (dict): generation parameters of the network
+    """
+    parent = os.path.dirname(os.path.abspath(folder))
+    os.makedirs(parent, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(dir=parent)
+    try:
+        for name in Network.ARRAYS:
+            np.save(os.path.join(tmp_folder, name + ".npy"), getattr(network, name))
+        with open(os.path.join(tmp_folder, "params.json"), "w", encoding="utf-8") as file:
+            json.dump(params, file, indent=4)
+        os.replace(tmp_folder, folder)
+    except OSError:
+        # Another run saved the same network in the meantime
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def load_network(folder: str) -> Network:
+    """Load a network saved with save_network, arrays are memory-mapped (read-only)"""
+    return Network(
+        **{
+            name: np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+            for name in Network.ARRAYS
+        }
+    )
+
+
+def cached_network(cache_dir: str, params: dict, build_network) -> Network:
+    """
+    Return the network built with the given params from the cache,
+    building and saving it on a cache miss.
+
+    Args:
+        cache_dir (str): folder of the cache
+        params (dict): generation parameters (including the seed), used as cache key
+        build_network (callable): function that builds the network
+
+    Returns:
+        Network: the cached (memory-mapped) or newly built network
+    """
+    params = {"cache_version": CACHE_VERSION, **params}
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    folder = os.path.join(cache_dir, key)
+    if os.path.isdir(folder):
+        return load_network(folder)
+    network = build_network()
+    save_network(network, folder, params)
+    return network
+
+
+def share_network(comm_world: MPI.Intracomm, build_network) -> Network:
+    """
+    Build the network once (on rank 0) and share it with all the processes.
+    Each array is published in an MPI shared memory window per node: the first rank
+    of every node receives the arrays from rank 0 and the other ranks of the node map them.
+
+    Args:
+        comm_world (MPI.Intracomm): communicator of all the processes
+        build_network (callable): function that returns the Network, only called on rank 0
+
+    Returns:
+        Network: network backed by the shared memory of the node (read-only by convention)
+    """
+    rank = comm_world.Get_rank()
+    node_comm = comm_world.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    is_node_leader = node_comm.Get_rank() == 0
+    leader_comm = comm_world.Split(0 if is_node_leader else MPI.UNDEFINED, key=rank)
+
+    network = build_network() if rank == 0 else None
+    layout = (
+        {
+            name: (getattr(network, name).shape, getattr(network, name).dtype.str)
+            for name in Network.ARRAYS
+        }
+        if rank == 0
+        else None
+    )
+    layout = comm_world.bcast(layout, root=0)
+
+    arrays = {}
+    windows = []
+    for name, (shape, dtype) in layout.items():
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize if is_node_leader else 0
+        window = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=node_comm)
+        buffer, _ = window.Shared_query(0)
+        array = np.ndarray(buffer=buffer, dtype=dtype, shape=shape)
+        if is_node_leader:
+            if rank == 0:
+                array[...] = getattr(network, name)
+            leader_comm.Bcast(array, root=0)
+        arrays[name] = array
+        windows.append(window)
+    node_comm.Barrier()
+
+    shared = Network(**arrays)
+    shared.windows = windows
+    return shared
@@ -0,0 +1,548 @@
+"""
+Writers of the output files (of the analyzer, or of the writer ranks, see writer_process.py).
+Each output file is written by a sink:
+    csv: one row per action, ids in their string form (e.g. "P3_u12")
+    npz: columnar chunks of chunk_rows rows (activities-00000.npz, ...) listed in a
+        manifest (activities.json), ids kept as 64-bit integers (see action.py) and
+        missing ids and values stored as NO_ID and nan. Use read_columns to load them.
+Both writers open the sinks once and keep them open for the whole run.
+The direct writer writes the actions of a batch as soon as they are received. The buffered
+writer collects the actions in memory and a background thread writes them to disk when
+flush_rows actions are pending or every flush_interval seconds, so the receive loop
+never waits on the disk.
+"""
+
+import os
+import csv
+import json
+import threading
+import numpy as np
+import pandas as pd
+import simtools
+from action import NO_ID, KIND_PREFIX, make_aid, aid_kind, aid_uid, aid_counter
+from message import ACTIVITY_COLUMNS
+from view import ViewRecords, VIEW_COLUMNS, VIEW_DTYPE, VIEW_FIELDS, pack_views
+
+
+def activity_rows(messages: list) -> list:
+    return [m.write_action() for m in messages]
+
+
+def passivity_rows(passive_actions: list) -> list:
+    rows = []
+    for a in passive_actions:
+        if isinstance(a, ViewRecords):
+            rows.extend(a.write_actions())
+        else:
+            rows.append(a.write_action())
+    return rows
+
+
+def activity_columns(messages: list) -> dict:
+    """Columns of the activity file (ACTIVITY_COLUMNS) as arrays"""
+    return {
+        "message_id": np.array([m.aid for m in messages], dtype=np.int64),
+        "user_id": np.array([m.uid for m in messages], dtype=np.int64),
+        "quality": np.array([m.quality for m in messages], dtype=np.float64),
+        "appeal": np.array([m.appeal for m in messages], dtype=np.float64),
+        "reshared_id": np.array([m.reshared_id for m in messages], dtype=np.int64),
+        "reshared_user_id": np.array(
+            [m.reshared_user_id for m in messages], dtype=np.int64
+        ),
+        "reshared_original_id": np.array(
+            [m.reshared_original_id for m in messages], dtype=np.int64
+        ),
+        # None is converted to nan
+        "clock_time": np.array([m.time for m in messages], dtype=np.float64),
+    }
+
+
+def passivity_columns(passive_actions: list) -> dict:
+    """Columns of the passivity file (any of VIEW_COLUMNS) as arrays"""
+    records = pack_views(passive_actions)
+    return {column: records[field] for column, field in VIEW_FIELDS.items()}
+
+
+# Conversion of the actions of each output file, to rows and to columns
+ROWS = {"activity": activity_rows, "passivity": passivity_rows}
+COLUMNS = {"activity": activity_columns, "passivity": passivity_columns}
+
+
+class CsvFile:
+    """Output file with one row per action (the header is written by simtools.init_files)"""
+
+    def __init__(self, name: str, path: str, columns: list, chunk_rows: int) -> None:
+        self.rows = ROWS[name]
+        self.file = open(path, "a", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+
+    def write(self, actions: list) -> None:
+        self.writer.writerows(self.rows(actions))
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class NpzFile:
+    """Output file stored as columnar chunks listed in a manifest"""
+
+    def __init__(self, name: str, path: str, columns: list, chunk_rows: int) -> None:
+        self.to_columns = COLUMNS[name]
+        self.path = path
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self.pending = []
+        self.n_pending = 0
+        remove_columns(path)
+        write_manifest(path, columns, self.chunks)
+
+    def write(self, actions: list) -> None:
+        columns = self.to_columns(actions)
+        n_rows = len(columns[self.columns[0]])
+        if n_rows:
+            self.pending.append(columns)
+            self.n_pending += n_rows
+        if self.n_pending >= self.chunk_rows:
+            self.write_chunk()
+
+    def write_chunk(self) -> None:
+        if not self.n_pending:
+            return
+        columns = {
+            column: np.concatenate([pending[column] for pending in self.pending])
+            for column in self.columns
+        }
+        self.chunks.append(write_chunk(self.path, len(self.chunks), columns))
+        write_manifest(self.path, self.columns, self.chunks)
+        self.pending = []
+        self.n_pending = 0
+
+    def flush(self) -> None:
+        # Chunks are written only when full, so that they are not too small
+        pass
+
+    def close(self) -> None:
+        self.write_chunk()
+
+
+class ViewCounts:
+    """
+    Passivity sink of the aggregated and exposure recordings. The agent handlers count
+    the views of each activation, the counts of all the activations are summed here per
+    (viewer, message), or per message, and written to the wrapped sink when it is closed.
+    Pending records are merged into the totals once they outnumber them, so the memory
+    is bounded by the number of distinct keys.
+    """
+
+    def __init__(self, sink, recording: str) -> None:
+        self.sink = sink
+        self.recording = recording
+        self.totals = np.zeros(0, dtype=VIEW_DTYPE)
+        self.pending = []
+        self.n_pending = 0
+
+    def write(self, actions: list) -> None:
+        records = pack_views(actions)
+        if len(records):
+            self.pending.append(records)
+            self.n_pending += len(records)
+        if self.n_pending > max(len(self.totals), 10000):
+            self.merge()
+
+    def merge(self) -> None:
+        """Sum the pending counts into the totals"""
+        if not self.pending:
+            return
+        records = np.concatenate([self.totals] + self.pending)
+        # Exposure records have no viewer (NO_ID), so they are keyed by message only
+        keys, first, inverse = np.unique(
+            np.stack((records["uid"], records["parent_mid"]), axis=1),
+            axis=0,
+            return_index=True,
+            return_inverse=True,
+        )
+        totals = records[first]
+        totals["count"] = np.bincount(
+            inverse.ravel(), weights=records["count"], minlength=len(keys)
+        )
+        self.totals = totals
+        self.pending = []
+        self.n_pending = 0
+
+    def flush(self) -> None:
+        # Counts are written once, when the sink is closed
+        pass
+
+    def close(self) -> None:
+        self.merge()
+        if len(self.totals):
+            self.sink.write([ViewRecords(self.recording, self.totals)])
+        self.sink.close()
+
+
+# Recordings whose views are counted across activations (see ViewCounts)
+COUNTED_RECORDINGS = ("aggregated", "exposure")
+
+
+def columns_path(path: str) -> str:
+    """Path of an output file without its extension"""
+    return os.path.splitext(path)[0]
+
+
+def write_chunk(path: str, index: int, columns: dict) -> dict:
+    """Write a chunk of an npz output file
+
+    Returns:
+        dict: entry of the chunk in the manifest
+    """
+    file = f"{columns_path(path)}-{index:05d}.npz"
+    np.savez_compressed(file, **columns)
+    return {"file": os.path.basename(file), "rows": len(next(iter(columns.values())))}
+
+
+def write_manifest(path: str, columns: list, chunks: list) -> None:
+    manifest = {"columns": columns, "missing_id": NO_ID, "chunks": chunks}
+    with open(columns_path(path) + ".json", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+
+
+def read_manifest(path: str) -> dict:
+    with open(columns_path(path) + ".json", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def remove_columns(path: str) -> None:
+    """Remove the manifest and the chunks of an npz output file, if any"""
+    if not os.path.isfile(columns_path(path) + ".json"):
+        return
+    folder = os.path.dirname(path)
+    for chunk in read_manifest(path)["chunks"]:
+        os.remove(os.path.join(folder, chunk["file"]))
+    os.remove(columns_path(path) + ".json")
+
+
+def read_columns(path: str) -> dict:
+    """Load an npz output file
+
+    Args:
+        path (str): path of the output file (e.g. files/<time>/activities.csv),
+            the extension is ignored
+
+    Returns:
+        dict: array of each column (e.g. pd.DataFrame(read_columns(path)))
+    """
+    manifest = read_manifest(path)
+    folder = os.path.dirname(path)
+    chunks = []
+    for chunk in manifest["chunks"]:
+        with np.load(os.path.join(folder, chunk["file"])) as data:
+            chunks.append({column: data[column] for column in manifest["columns"]})
+    return {
+        column: (
+            np.concatenate([chunk[column] for chunk in chunks])
+            if chunks
+            else np.zeros(0)
+        )
+        for column in manifest["columns"]
+    }
+
+
+def segment_path(path: str, segment: int) -> str:
+    """Path of the segment of an output file written by a writer rank
+
+    Args:
+        path (str): path of the output file (e.g. files/<time>/activities.csv)
+        segment (int): index of the writer rank
+
+    Returns:
+        str: path of the segment (e.g. files/<time>/activities-w0.csv)
+    """
+    base, extension = os.path.splitext(path)
+    return f"{base}-w{segment}{extension}"
+
+
+def write_index(folder_path: str, output_format: str, paths: dict, n_segments: int) -> None:
+    """List the segments of the output files written by the writer ranks
+
+    Args:
+        folder_path (str): output folder
+        output_format (str): "csv" or "npz"
+        paths (dict): path of each output file, by name
+        n_segments (int): number of writer ranks
+    """
+    # The cutoff is written at termination, if the action ids are unique
+    index = {"format": output_format, "cutoff": "cutoff.npz"}
+    for name, path in paths.items():
+        index[name] = [
+            os.path.basename(segment_path(path, segment)) for segment in range(n_segments)
+        ]
+    with open(os.path.join(folder_path, "segments.json"), "w", encoding="utf-8") as file:
+        json.dump(index, file, indent=2)
+
+
+def write_cutoff(folder_path: str, limits: np.ndarray) -> None:
+    """
+    Save the actions counted by the analyzer: the writer ranks also persist the actions
+    that were still in flight when the simulation terminated, read_segments drops them.
+
+    Args:
+        folder_path (str): output folder
+        limits (np.ndarray): (3, n_users) number of posts, reshares and views of each
+            user counted by the analyzer (see action.POST, RESHARE and VIEW)
+    """
+    np.savez(os.path.join(folder_path, "cutoff.npz"), limits=limits)
+
+
+def parse_aids(ids) -> np.ndarray:
+    """Action ids from their string form (e.g. "P3_u12"), missing ids become NO_ID"""
+    parts = pd.Series(ids, dtype=object).astype(str).str.extract(r"^([PRV])(\d+)_u(\d+)$")
+    valid = parts[0].notna().to_numpy()
+    aids = np.full(len(parts), NO_ID, dtype=np.int64)
+    kinds = parts[0][valid].map({prefix: kind for kind, prefix in enumerate(KIND_PREFIX)})
+    aids[valid] = make_aid(
+        kinds.to_numpy(dtype=np.int64),
+        parts[2][valid].to_numpy(dtype=np.int64),
+        parts[1][valid].to_numpy(dtype=np.int64),
+    )
+    return aids
+
+
+def read_segments(folder_path: str, name: str) -> pd.DataFrame:
+    """Load an output file written by the writer ranks
+
+    Args:
+        folder_path (str): output folder (with the segments.json index)
+        name (str): "activity" or "passivity"
+
+    Returns:
+        pd.DataFrame: rows of all the segments. With a cutoff (see write_cutoff) the
+            actions that the analyzer did not count are dropped (aggregated views are
+            all kept, they have no action id). The view counts of the segments are
+            summed per (viewer, message), or per message
+    """
+    with open(os.path.join(folder_path, "segments.json"), encoding="utf-8") as file:
+        index = json.load(file)
+    frames = []
+    for segment in index[name]:
+        path = os.path.join(folder_path, segment)
+        if index["format"] == "npz":
+            frames.append(pd.DataFrame(read_columns(path)))
+        else:
+            frames.append(pd.read_csv(path))
+    df = pd.concat(frames, ignore_index=True)
+    if "n_views" in df.columns:
+        keys = [column for column in df.columns if column != "n_views"]
+        return df.groupby(keys, sort=False, as_index=False)["n_views"].sum()
+    id_column = "message_id" if name == "activity" else "action_id"
+    cutoff = os.path.join(folder_path, index["cutoff"])
+    if id_column not in df.columns or not os.path.isfile(cutoff):
+        return df
+    with np.load(cutoff) as data:
+        limits = data["limits"]
+    aids = df[id_column].to_numpy()
+    if index["format"] == "csv":
+        aids = parse_aids(aids)
+    counted = aid_counter(aids) < limits[aid_kind(aids), aid_uid(aids)]
+    return df[counted].reset_index(drop=True)
+
+
+SINKS = {"csv": CsvFile, "npz": NpzFile}
+
+
+def make_sink(
+    output_format: str, name: str, path: str, columns: list, chunk_rows: int = 100000
+):
+    """Create the sink of an output file
+
+    Args:
+        output_format (str): "csv" or "npz"
+        name (str): "activity" or "passivity"
+        path (str): path of the output file (npz files replace the extension)
+        columns (list): columns of the file (ACTIVITY_COLUMNS or one of VIEW_COLUMNS)
+        chunk_rows (int): rows of each npz chunk
+
+    Returns:
+        the sink (CsvFile or NpzFile)
+    """
+    return SINKS[output_format](name, path, columns, chunk_rows)
+
+
+class DirectWriter:
+    """Write the actions to the output files right away"""
+
+    def __init__(self, sinks: dict, **kwargs) -> None:
+        """
+        Args:
+            sinks (dict): sink of each output file, by name (e.g. "activity")
+        """
+        self.sinks = sinks
+
+    def write(self, name: str, actions: list) -> None:
+        """Append actions to an output file
+
+        Args:
+            name (str): name of the output file
+            actions (list): messages (activity) or passive actions (passivity)
+        """
+        self.sinks[name].write(actions)
+
+    def close(self) -> None:
+        """Write everything to disk and close the files"""
+        for sink in self.sinks.values():
+            sink.close()
+
+
+class BufferedWriter(DirectWriter):
+    """Buffer the actions in memory and write them to disk from a background thread"""
+
+    def __init__(
+        self, sinks: dict, flush_rows: int = 10000, flush_interval: float = 1.0
+    ) -> None:
+        """
+        Args:
+            sinks (dict): sink of each output file, by name (e.g. "activity")
+            flush_rows (int): number of pending actions that triggers a flush
+            flush_interval (float): max seconds between two flushes
+        """
+        super().__init__(sinks)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.pending = {name: [] for name in sinks}
+        self.n_pending = 0
+        self.closed = False
+        # Error raised by the background thread, reported by the next write or close
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, name: str, actions: list) -> None:
+        with self.condition:
+            if self.error:
+                raise self.error
+            self.pending[name].extend(actions)
+            self.n_pending += len(actions)
+            if self.n_pending >= self.flush_rows:
+                self.condition.notify()
+
+    def run(self) -> None:
+        """Background thread: swap the pending actions with empty buffers and write them"""
+        while True:
+            with self.condition:
+                if not self.closed and self.n_pending < self.flush_rows:
+                    self.condition.wait(self.flush_interval)
+                pending = self.pending
+                self.pending = {name: [] for name in pending}
+                self.n_pending = 0
+                closed = self.closed
+            try:
+                for name, actions in pending.items():
+                    if actions:
+                        self.sinks[name].write(actions)
+                for sink in self.sinks.values():
+                    sink.flush()
+            except Exception as e:
+                self.error = e
+                return
+            if closed:
+                return
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        super().close()
+        if self.error:
+            raise self.error
+
+
+WRITERS = {"direct": DirectWriter, "buffered": BufferedWriter}
+
+
+def make_writer(
+    output_writer: str,
+    sinks: dict,
+    flush_rows: int = 10000,
+    flush_interval: float = 1.0,
+) -> DirectWriter:
+    """Create the writer of the analyzer output
+
+    Args:
+        output_writer (str): "direct" or "buffered"
+        sinks (dict): sink of each output file, by name (see make_sink)
+        flush_rows (int): number of pending actions that triggers a flush (buffered writer)
+        flush_interval (float): max seconds between two flushes (buffered writer)
+
+    Returns:
+        DirectWriter: the writer
+    """
+    return WRITERS[output_writer](
+        sinks, flush_rows=flush_rows, flush_interval=flush_interval
+    )
+
+
+def open_output(
+    file_path_activity: str,
+    file_path_passivity: str,
+    view_recording: str = "full",
+    save_active_interactions: bool = True,
+    save_passive_interactions: bool = True,
+    output_writer: str = "direct",
+    output_flush_rows: int = 10000,
+    output_flush_interval: float = 1.0,
+    output_format: str = "csv",
+    output_chunk_rows: int = 100000,
+) -> DirectWriter:
+    """Initialize the output files and create their writer
+
+    Args:
+        file_path_activity (str): path of the file that contains active actions
+        file_path_passivity (str): path of the file that contains passive actions
+        view_recording (str): how the views are recorded (see view.VIEW_RECORDINGS)
+        save_active_interactions (bool): write the active actions
+        save_passive_interactions (bool): write the passive actions
+        output_writer (str): "direct" or "buffered"
+        output_flush_rows (int): number of pending actions that triggers a flush
+        output_flush_interval (float): max seconds between two flushes
+        output_format (str): "csv" or "npz"
+        output_chunk_rows (int): rows of each npz chunk
+
+    Returns:
+        DirectWriter: the writer, with a sink for each saved file
+    """
+    # npz sinks write their own manifest
+    if output_format == "csv":
+        simtools.init_files(
+            os.path.dirname(file_path_activity),
+            file_path_activity,
+            file_path_passivity,
+            passivity_columns=VIEW_COLUMNS[view_recording],
+        )
+    else:
+        os.makedirs(os.path.dirname(file_path_activity), exist_ok=True)
+    output_files = {
+        "activity": (file_path_activity, ACTIVITY_COLUMNS, save_active_interactions),
+        "passivity": (
+            file_path_passivity,
+            VIEW_COLUMNS[view_recording],
+            save_passive_interactions,
+        ),
+    }
+    sinks = {
+        name: make_sink(output_format, name, path, columns, chunk_rows=output_chunk_rows)
+        for name, (path, columns, save) in output_files.items()
+        if save
+    }
+    if "passivity" in sinks and view_recording in COUNTED_RECORDINGS:
+        sinks["passivity"] = ViewCounts(sinks["passivity"], view_recording)
+    return make_writer(
+        output_writer,
+        sinks,
+        flush_rows=output_flush_rows,
+        flush_interval=output_flush_interval,
+    )
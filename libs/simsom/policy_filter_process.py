@@ -1,5 +1,6 @@
 from mpi4py import MPI
 import time
+from instrumentation import PROFILER
 
 
 def run_policy_filter(
@@ -18,13 +19,21 @@ def run_policy_filter(
     # DEBUG COUNTER
     count = 0
 
+    # Number of agent handlers that sent the termination signal
+    n_closed = 0
+
     # Bootstrap sync
     comm_world.Barrier()
 
     while True:
 
-        data = comm_world.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        with PROFILER.phase("recv"):
+            data = comm_world.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
         if data == "sigterm":
+            # Keep receiving until all the agent handlers are closed
+            n_closed += 1
+            if n_closed < size - rank_index["agent_handler"]:
+                continue
             # print("- Policy filter >> termination signal")
 
             # Flush pending incoming messages
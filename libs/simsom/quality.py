@@ -0,0 +1,79 @@
+"""
+Sampler of the quality of the messages.
+Qualities are drawn from a beta distribution, rounded to 2 decimals and truncated to
+[lower, upper] (see Message.custom_beta_quality). Since the rounded values lie on a grid
+of 101 values, the truncated distribution is tabulated once per quality params tuple
+(from the beta CDF) and sampled by inverse CDF, a pool of values at a time.
+"""
+
+import numpy as np
+from scipy.special import betainc
+
+# Values a quality rounded to 2 decimals can take
+GRID = np.arange(101) / 100
+# Bounds of the values rounded to each grid value
+EDGES = np.clip((np.arange(102) - 0.5) / 100, 0, 1)
+
+
+def truncated_beta_cdf(alpha: float, beta: float, lower: float, upper: float) -> np.ndarray:
+    """Cumulative distribution of a beta value rounded to 2 decimals and kept only within bounds
+
+    Args:
+        alpha (float): alpha of the beta distribution
+        beta (float): beta of the beta distribution
+        lower (float): lower bound of the quality
+        upper (float): upper bound of the quality
+
+    Returns:
+        np.ndarray: cumulative probability of each grid value
+    """
+    pmf = np.diff(betainc(alpha, beta, EDGES))
+    pmf[(GRID < lower) | (GRID > upper)] = 0
+    if pmf.sum() <= 0:
+        raise ValueError(f"No quality can be drawn with params {(alpha, beta, lower, upper)}")
+    cdf = np.cumsum(pmf) / pmf.sum()
+    # Make sure every uniform draw falls on a value with positive probability
+    cdf[np.flatnonzero(pmf)[-1] :] = 1
+    return cdf
+
+
+class QualitySampler:
+    """
+    Truncated beta sampler shared by all the messages of a process.
+    Distributions are tabulated per quality params tuple and values are drawn
+    pool_size at a time.
+    """
+
+    def __init__(self, pool_size: int = 1024) -> None:
+        self.pool_size = pool_size
+        self.tables = {}
+        self.pools = {}
+
+    def table(self, params: tuple) -> np.ndarray:
+        if params not in self.tables:
+            self.tables[params] = truncated_beta_cdf(*params)
+        return self.tables[params]
+
+    def draw(self, params: tuple, size: int, rng=np.random) -> np.ndarray:
+        """Draw qualities with the given params
+
+        Args:
+            params (tuple): alpha, beta, lower and upper bound
+            size (int): number of values
+            rng: random generator (np.random or a np.random.Generator)
+
+        Returns:
+            np.ndarray: qualities
+        """
+        return GRID[np.searchsorted(self.table(params), rng.random(size), side="right")]
+
+    def sample(self, params: tuple) -> float:
+        """Draw one quality from the pool of the given params (refilled when empty)"""
+        pool = self.pools.get(params)
+        if not pool:
+            pool = self.pools[params] = self.draw(params, self.pool_size).tolist()
+        return pool.pop()
+
+
+# Sampler of the process
+QUALITY_SAMPLER = QualitySampler()
@@ -0,0 +1,64 @@
+"""
+Vectorized scoring engine for the recommender system.
+The topic vectors of the messages in the inventory are kept in a float32 matrix
+(see inventory.py) so that a whole batch of users can be scored with a single matrix product.
+"""
+
+import numpy as np
+
+N_TOPICS = 15
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale each row of the matrix to unit length (zero rows are left untouched)
+
+    Args:
+        matrix (np.ndarray): 2D float matrix
+
+    Returns:
+        np.ndarray: row-normalized float32 matrix
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class VectorRanker:
+    """
+    Score users against the (unit-normalized) topic vectors stored in the columns
+    of a message inventory.
+    """
+
+    def __init__(self, inventory) -> None:
+        self.inventory = inventory
+
+    def score(self, users: list) -> np.ndarray:
+        """Cosine similarity between every user of the batch and every inventory slot
+
+        Args:
+            users (list): users of the batch
+
+        Returns:
+            np.ndarray: (n_users, capacity) float32 matrix of scores (empty slots score 0)
+        """
+        user_vectors = normalize_rows([user.user_topics for user in users])
+        return user_vectors @ self.inventory.topics.T
+
+    @staticmethod
+    def top_k(scores: np.ndarray, candidates: np.ndarray, k: int) -> np.ndarray:
+        """Select the k candidates with the highest score (partial selection, no sort)
+
+        Args:
+            scores (np.ndarray): scores of one user against the whole inventory
+            candidates (np.ndarray): inventory slots to choose from
+            k (int): number of candidates to keep
+
+        Returns:
+            np.ndarray: inventory slots of the selected candidates, in no particular order
+        """
+        if k <= 0 or len(candidates) == 0:
+            return candidates[:0]
+        if k >= len(candidates):
+            return candidates
+        return candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
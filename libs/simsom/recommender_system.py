@@ -3,7 +3,15 @@ from sklearn.metrics.pairwise import cosine_similarity
 import time
 import numpy as np
 import random
+import heapq
+import pandas as pd
 from collections import Counter
+from ranking import VectorRanker
+from inventory import MessageInventory
+from action import NO_ID
+from user import Activation
+from transport import make_transport, FEED_BATCH, ANALYZER_BATCH
+from instrumentation import PROFILER
 
 def calculate_cosine_similarity(list_a: list, list_b: list) -> float:
     """
@@ -25,11 +33,153 @@ def calculate_cosine_similarity(list_a: list, list_b: list) -> float:
     cosine = dot / (len_a * len_b) 
     return cosine
 
+def top_based_topics(messages: list, agent, k: int) -> list:
+    """
+    Select the k messages most similar to the user's topics (best first).
+    Equivalent to sorting by similarity and taking the first k, but uses a heap.
+    """
+    if k <= 0 or len(messages) == 0:
+        return []
+    user_topics = agent.user_topics.tolist()
+    return heapq.nlargest(
+        k,
+        messages,
+        key=lambda message: calculate_cosine_similarity(user_topics, message.topics),
+    )
+
+
+def build_feed(agent, in_messages, out_messages, in_perc=0.5, out_perc=0.5) -> list:
+    """
+    Build the newsfeed for the agent based on the incoming and outgoing messages.
+    """
+    # If there are no messages, return an empty list
+    if not in_messages and not out_messages:
+        return []
+    # Get percentages of messages to keep from in and out, based on topics
+    n_in = int(len(in_messages) * in_perc)
+    n_out = int(len(out_messages) * out_perc)
+    new_feed = top_based_topics(in_messages, agent, n_in) + top_based_topics(
+        out_messages, agent, n_out
+    )
+    # Drop duplicates and cut off the newsfeed
+    agent.newsfeed = clean_feed(new_feed, agent.cut_off)
+    return agent.newsfeed
+
+
+def clean_feed(newsfeed: list, k: int = None) -> list:
+    """
+    Clean the newsfeed for the agent removing duplicates (reshare of the same message).
+    Only the most recent reshare is kept, weighted by the number of times the original
+    message appears. Return the k messages with the highest (weight, time), best first.
+    """
+    weight_dict = {}
+    message_filter_dict = {}
+    nan_parents = []
+    # Iterate to check if there are duplicated reshare messages
+    for message in newsfeed:
+        if message.reshared_original_id == NO_ID:
+            nan_parents.append(message)
+        else:
+            # check for duplicates and if they are present keep track of the weight (n of time they appear)
+            original_id = message.reshared_original_id
+            if original_id not in message_filter_dict:
+                message_filter_dict[original_id] = message
+                weight_dict[original_id] = 1
+            else:
+                if message.time > message_filter_dict[original_id].time:
+                    message_filter_dict[original_id] = message
+                weight_dict[original_id] += 1
+    new_newsfeed = list(message_filter_dict.values()) + nan_parents
+    if k is None:
+        k = len(new_newsfeed)
+
+    # Select based on the weight and temporally
+    return heapq.nlargest(
+        k,
+        new_newsfeed,
+        key=lambda x: (weight_dict.get(x.reshared_original_id, 0), x.time),
+    )
+
+
+def build_feed_from_scores(
+    agent, inventory, scores, in_perc=0.5, out_perc=0.5
+) -> list:
+    """
+    Build the newsfeed for the agent from its scores against the whole inventory
+    (numpy ranking engine).
+    """
+    if not inventory:
+        return []
+    in_slots, out_slots = inventory.split_by_authors(agent.friends)
+    # Keep the best scored percentage of messages from in and out
+    n_in = int(len(in_slots) * in_perc)
+    n_out = int(len(out_slots) * out_perc)
+    selected = np.concatenate(
+        (
+            VectorRanker.top_k(scores, in_slots, n_in),
+            VectorRanker.top_k(scores, out_slots, n_out),
+        )
+    )
+    # Drop duplicates and cut off the newsfeed
+    agent.newsfeed = [
+        inventory[slot] for slot in clean_feed_slots(inventory, selected, agent.cut_off)
+    ]
+    return agent.newsfeed
+
+
+def clean_feed_slots(inventory, slots: np.ndarray, k: int) -> np.ndarray:
+    """
+    Same as clean_feed, but working on the columns of the inventory.
+
+    Args:
+        inventory (MessageInventory): inventory the slots refer to
+        slots (np.ndarray): slots of the candidate messages
+        k (int): size of the newsfeed
+
+    Returns:
+        np.ndarray: slots of the newsfeed, best first
+    """
+    if k <= 0 or len(slots) == 0:
+        return slots[:0]
+    times = inventory.time[slots]
+    original_ids = inventory.reshared_original_id[slots]
+    weights = np.zeros(len(slots), dtype=np.int64)
+    keep = original_ids == NO_ID
+    reshares = np.flatnonzero(~keep)
+    if len(reshares):
+        # Group reshares by original message and keep the most recent of each group
+        codes, uniques = pd.factorize(original_ids[reshares])
+        latest = np.full(len(uniques), -np.inf)
+        np.maximum.at(latest, codes, times[reshares])
+        is_latest = times[reshares] == latest[codes]
+        first = np.full(len(uniques), len(slots))
+        np.minimum.at(first, codes[is_latest], reshares[is_latest])
+        keep[first] = True
+        weights[first] = np.bincount(codes, minlength=len(uniques))
+    kept = np.flatnonzero(keep)
+    # Order by (weight, time): time is shifted to [0, span) so the weight dominates
+    span = times.max() - times.min() + 1
+    key = weights[kept] * span + (times[kept] - times.min())
+    if k < len(kept):
+        kept = kept[np.argpartition(-key, k - 1)[:k]]
+        key = weights[kept] * span + (times[kept] - times.min())
+    return slots[kept[np.argsort(-key, kind="stable")]]
+
+
 def run_recommender_system(
     comm_world: MPI.Intercomm,
     rank: int,
     size: int,  # If needed for future logic
     rank_index: dict,
+    ranking_engine: str = "counter",
+    inventory_capacity: int = 2000,
+    inventory_ttl: float = None,
+    inventory_max_bytes: int = None,
+    network=None,
+    user_transfer: str = "object",
+    transport: str = "pickle",
+    # Send the actions (or their statistics) to the analyzer
+    analyzer_stream: bool = True,
 ):
 
     # Verbose: use flush=True to print messages
@@ -38,7 +188,52 @@ def run_recommender_system(
     # Status of the processes
     status = MPI.Status()
 
-    global_inventory = []
+    # Pickled objects or packed buffers
+    channel = make_transport(comm_world, transport)
+
+    global_inventory = MessageInventory(
+        capacity=inventory_capacity,
+        ttl=inventory_ttl,
+        max_bytes=inventory_max_bytes,
+    )
+
+    # Score users against the inventory topic vectors with the numpy ranking engine
+    ranker = VectorRanker(global_inventory) if ranking_engine == "numpy" else None
+
+    # Users are sharded across the recommender system ranks, each shard builds the feeds
+    # of its own users and replicates their new messages in the inventory of the other shards
+    shard_comm = None
+    pending_requests = []
+    if len(rank_index["recommender_system"]) > 1:
+        shard_comm = comm_world.Create_group(
+            comm_world.Get_group().Incl(rank_index["recommender_system"])
+        )
+
+    def receive_shared_messages():
+        """Add to the inventory the messages sent by the other shards"""
+        while shard_comm.Iprobe(source=MPI.ANY_SOURCE):
+            global_inventory.extend(shard_comm.recv(source=MPI.ANY_SOURCE))
+
+    def share_messages(messages: list):
+        """Send the new messages of the users of this shard to the other shards"""
+        for peer in range(shard_comm.Get_size()):
+            if peer != shard_comm.Get_rank():
+                pending_requests.append(shard_comm.issend(messages, dest=peer))
+        # Forget the requests that are already completed
+        pending_requests[:] = [req for req in pending_requests if not req.Test()]
+
+    def close_shards():
+        """
+        Drain the messages still in flight between shards: once all our (synchronous) sends
+        are received we enter a non-blocking barrier and keep draining until everyone did.
+        """
+        barrier = None
+        while barrier is None or not barrier.Test():
+            while shard_comm.Iprobe(source=MPI.ANY_SOURCE):
+                _ = shard_comm.recv(source=MPI.ANY_SOURCE)
+            if barrier is None and MPI.Request.Testall(pending_requests):
+                barrier = shard_comm.Ibarrier()
+        shard_comm.Free()
 
     # Function to check for termination signal
     # (non-blocking)
@@ -49,86 +244,20 @@ def run_recommender_system(
             return True
         return False
 
-    def sort_based_topics(messages: list, agent) -> list:
-        if len(messages) == 0:
-            return messages
-        user_topics = agent.user_topics
-
-        # Calculate the cosine similarity between the user's topics and the messages
-        similarities = [(calculate_cosine_similarity(user_topics, message.topics), message) for message in messages]
-
-        # Sort messages by similarity score, descending
-        ranked = sorted(similarities, key=lambda x: x[0], reverse=True)
-
-        # Return just the sorted messages
-        return [msg for _, msg in ranked]
-
-
-
-    def build_feed(agent, in_messages, out_messages, in_perc=0.5, out_perc=0.5) -> list:
-        """
-        Build the newsfeed for the agent based on the incoming and outgoing messages.
-        """
-        # If there are no messages, return an empty list
-        if not in_messages and not out_messages:
-            return []
-        # Sort the messages based on topics
-        in_messages = sort_based_topics(in_messages, agent)
-        out_messages = sort_based_topics(out_messages, agent)
-
-        # Get percentages of messages to keep from in and out
-        n_in = int(len(in_messages) * in_perc)
-        n_out = int(len(out_messages) * out_perc)
-        # Build the newsfeed and shuffle it
-        new_feed = in_messages[:n_in] + out_messages[:n_out]
-        new_feed = clean_feed(new_feed)
-        # Cut off the newsfeed if needed
-        if len(new_feed) > agent.cut_off:
-            new_feed = new_feed[: agent.cut_off]
-        agent.newsfeed = new_feed
-        return agent.newsfeed
-
-    def clean_feed(newsfeed):
-        """
-        Clean the newsfeed for the agent removing duplicates
-        """
-        weight_dict = {}
-        # Sort messages and drop duplicates (reshare)
-        sorted_messages = sorted(newsfeed, key=lambda x: x.time, reverse=True)
-        message_filter_dict = {}
-        nan_parents = []
-        # Iterate to check if there are duplicated reshare messages
-        for message in sorted_messages:
-            if message.reshared_original_id == np.nan:
-                nan_parents.append(message)
-            else:
-                # check for duplicates and if they are present keep track of the weight (n of time they appear)
-                if message.reshared_original_id not in message_filter_dict:
-                    message_filter_dict[message.reshared_original_id] = message
-                    weight_dict[message.reshared_original_id] = 1
-                else:
-                    weight_dict[message.reshared_original_id] += 1
-        new_newsfeed = list(message_filter_dict.values()) + nan_parents
-
-        # Sort list temporally and based on the weight
-        new_newsfeed = sorted(new_newsfeed, key=lambda x: x.time, reverse=True)
-        new_newsfeed = sorted(
-            new_newsfeed,
-            key=lambda x: (weight_dict.get(x.reshared_original_id, 0), x.time),
-            reverse=True,
-        )
-        return new_newsfeed
-
     # Close the process cleanly
     def close_process():
         # print("- RecSys >> termination signal, stopping simulation...", flush=True)
 
-        comm_world.send(("sigterm", 0), dest=rank_index["data_manager"])
         comm_world.send("sigterm", dest=rank_index["agent_pool_manager"])
+        # Let the analyzer know we will not send anything else
+        comm_world.send("sigterm", dest=rank_index["analyzer"])
+
+        if shard_comm is not None:
+            close_shards()
 
         # Flush pending incoming messages
         while comm_world.Iprobe(source=MPI.ANY_SOURCE, status=status):
-            _ = comm_world.recv(source=MPI.ANY_SOURCE, status=status)
+            _ = channel.recv(source=MPI.ANY_SOURCE, status=status)
         comm_world.Barrier()
 
     # Bootstrap sync
@@ -142,39 +271,60 @@ def run_recommender_system(
             close_process()
             break
         
-        data = comm_world.recv(source=rank_index["agent_pool_manager"], status=status)
+        with PROFILER.phase("recv"):
+            data = comm_world.recv(source=rank_index["agent_pool_manager"], status=status)
 
-        # Wait untile we receive data from the agent pool manager (agent pool manager may have not 
-        # enough users ready to pick them up so it will send empty list)
-        comm_world.send(("ping_recsys", 0), dest=rank_index["data_manager"])
-        data = comm_world.recv(source=rank_index["data_manager"], status=status)
+            # Wait untile we receive data from the agent pool manager (agent pool manager may have not 
+            # enough users ready to pick them up so it will send empty list)
+            comm_world.send(("ping_recsys", 0), dest=rank_index["data_manager"])
+            data = channel.recv(source=rank_index["data_manager"], status=status)
+        PROFILER.count("batch_size", len(data))
         # print("- RecSys >> data received.", flush=True)
         # print(data)
-        users = []
-        passivities = []
-        activities = []
-        # Unpack the data and iterate over the contents
-        for user , active_actions, passive_actions in data:
-            # Get the message from inside and outside the network
-            in_messages = []
-            out_messages = []
-            # Keep track of the messages using a global inventory
-            global_inventory.extend(active_actions)
-            for activity in global_inventory:
-                if activity.uid in user.friends:
-                    in_messages.append(activity)
+        if shard_comm is not None:
+            with PROFILER.phase("share_messages"):
+                receive_shared_messages()
+                share_messages([msg for _, active_actions, _ in data for msg in active_actions])
+        with PROFILER.phase("build_feed"):
+            if user_transfer == "delta":
+                # We receive activations, rebuild the users from the shared network
+                activations = [activation for activation, _, _ in data]
+                data = [
+                    (network.make_user(activation.uid), active_actions, passive_actions)
+                    for activation, active_actions, passive_actions in data
+                ]
+            users = []
+            passivities = []
+            activities = []
+            if ranker is not None:
+                # Add the messages of the whole batch to the inventory first,
+                # then score all the users with a single matrix product
+                for _, active_actions, _ in data:
+                    global_inventory.extend(active_actions)
+                scores = ranker.score([user for user, _, _ in data]) if data else None
+            # Unpack the data and iterate over the contents
+            for i, (user, active_actions, passive_actions) in enumerate(data):
+                if ranker is not None:
+                    user.newsfeed = build_feed_from_scores(user, global_inventory, scores[i])
                 else:
-                    out_messages.append(activity)
-            # Build the newsfeed for the agent 
-            user.newsfeed = build_feed(user, in_messages, out_messages)
-            # Collect the user and the actions so we can send them to the agent pool manager and analyzer
-            users.append(user)
-            passivities.extend(passive_actions)
-            activities.extend(active_actions)
-        
-        if len(global_inventory) > 2000:
-            # Remove the oldest 1000 messages so we don't run out of memory
-            global_inventory = global_inventory[-1000:] 
+                    # Keep track of the messages using a global inventory
+                    global_inventory.extend(active_actions)
+                    # Get the message from inside and outside the network
+                    in_slots, out_slots = global_inventory.split_by_authors(user.friends)
+                    in_messages = [global_inventory[slot] for slot in in_slots]
+                    out_messages = [global_inventory[slot] for slot in out_slots]
+                    # Build the newsfeed for the agent 
+                    user.newsfeed = build_feed(user, in_messages, out_messages)
+                # Collect the user and the actions so we can send them to the agent pool manager and analyzer
+                users.append(user)
+                passivities.extend(passive_actions)
+                activities.extend(active_actions)
+
+            if user_transfer == "delta":
+                # Send back only the activations with the new feeds
+                for activation, user in zip(activations, users):
+                    activation.newsfeed = user.newsfeed
+                users = activations
 
         # Check for termination signal (we need two of them because we risk
         # to miss the first one if we are busy processing data)
@@ -182,5 +332,26 @@ def run_recommender_system(
             close_process()
             break
         
-        comm_world.send((user, activities, passivities), dest=rank_index["analyzer"])
-        comm_world.send(users, dest=rank_index["agent_pool_manager"])
+        with PROFILER.phase("send"):
+            if users and analyzer_stream and rank_index["writer"]:
+                # The actions are persisted by the writer ranks, the analyzer only needs
+                # the counters of the users and the ids and qualities of the new messages
+                comm_world.send(
+                    (
+                        [Activation.from_user(user) for user in users],
+                        np.array([msg.aid for msg in activities], dtype=np.int64),
+                        [msg.quality for msg in activities],
+                    ),
+                    dest=rank_index["analyzer"],
+                )
+            elif users and analyzer_stream:
+                # One entry per activation, as in USER_BATCH
+                channel.send(
+                    [
+                        (Activation.from_user(user), active_actions, passive_actions)
+                        for user, (_, active_actions, passive_actions) in zip(users, data)
+                    ],
+                    dest=rank_index["analyzer"],
+                    kind=ANALYZER_BATCH,
+                )
+            channel.send(users, dest=rank_index["agent_pool_manager"], kind=FEED_BATCH)
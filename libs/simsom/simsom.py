@@ -25,24 +25,56 @@ import json
 from mpi4py import MPI
 import simtools
 import argparse
+from network import share_network
 
 from data_manager_process import run_data_manager
-from analyzer_process import run_analyzer
+from analyzer_process import run_analyzer, folder_path
 from policy_filter_process import run_policy_filter
 from agent_pool_manager_process import run_agent_pool_manager
 from agent_process import run_agent
 from recommender_system import run_recommender_system
+from writer_process import run_writer
+from instrumentation import PROFILER, write_profiles
 
 
-# Configuration constants
-RANK_INDEX = {
-    "data_manager": 0,
-    "recommender_system": 1,
-    "analyzer": 2,
-    "agent_pool_manager": 3,
-    "policy_filter": 4,
-    "agent_handler": 5,
-}
+
+def build_rank_index(n_recommenders: int = 1, n_writers: int = 0) -> dict:
+    """
+    Compute the rank layout of the simulation.
+    The recommender system role is a list of ranks, since users can be sharded
+    across more than one recommender (see simtools.user_shard).
+    The optional writer ranks persist the actions in place of the analyzer
+    (see writer_process.py).
+    All the ranks after the writers are agent handlers.
+
+    Args:
+        n_recommenders (int): number of recommender system ranks
+        n_writers (int): number of writer ranks
+
+    Returns:
+        dict: rank (or list of ranks) of each role
+    """
+    first = 1 + n_recommenders
+    return {
+        "data_manager": 0,
+        "recommender_system": list(range(1, first)),
+        "analyzer": first,
+        "agent_pool_manager": first + 1,
+        "policy_filter": first + 2,
+        "writer": list(range(first + 3, first + 3 + n_writers)),
+        "agent_handler": first + 3 + n_writers,
+    }
+
+
+def rank_role(rank: int, rank_index: dict) -> str:
+    """Name of the role of a rank (see build_rank_index)"""
+    if rank >= rank_index["agent_handler"]:
+        return "agent_handler"
+    for role, ranks in rank_index.items():
+        if rank == ranks or (isinstance(ranks, list) and rank in ranks):
+            return role
+    return "unknown"
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -66,6 +98,12 @@ with open(args.network_spec, "r", encoding="utf-8") as file:
 with open(args.simulator_spec, "r", encoding="utf-8") as file:
     simulator_config = json.load(file)
 
+# Configuration constants
+RANK_INDEX = build_rank_index(
+    n_recommenders=simulator_config["n_recommenders"],
+    n_writers=simulator_config["n_writers"],
+)
+
 
 def main():
 
@@ -73,30 +111,64 @@ def main():
     size = comm_world.Get_size()
     rank = comm_world.Get_rank()
 
-    # Simulation contstraints (parametrize)
-    users = (
-        simtools.init_network(file=network_config["real_world_netowork"])
-        if network_config["real_world_netowork"]
-        else simtools.init_network(
-            net_size=network_config["net_size"],
-            p=network_config["probability_follow"],
-            k_out=network_config["avg_n_friend"],
-        )
-    )
+    if size <= RANK_INDEX["agent_handler"]:
+        if rank == 0:
+            print(
+                f"Error: This program requires at least {RANK_INDEX['agent_handler'] + 1} processes"
+            )
+        sys.exit(1)
+
+    # Packed buffers only carry the user activations
+    if simulator_config["transport"] == "buffer" and simulator_config["user_transfer"] != "delta":
+        if rank == 0:
+            print('Error: transport "buffer" requires user_transfer "delta"')
+        sys.exit(1)
 
-    if size < 6:
+    # The writer segments are cut with the action ids, unique only in delta mode
+    if simulator_config["n_writers"] > 0 and simulator_config["user_transfer"] != "delta":
         if rank == 0:
-            print("Error: This program requires at least 6 processes")
+            print('Error: n_writers > 0 requires user_transfer "delta"')
         sys.exit(1)
 
+    # Simulation contstraints (parametrize)
+    # The network is built once and shared with the processes through shared memory
+    network = share_network(
+        comm_world,
+        lambda: (
+            simtools.build_network(
+                file=network_config["real_world_netowork"],
+                seed=network_config["seed"],
+                cache_dir=network_config["cache_dir"],
+            )
+            if network_config["real_world_netowork"]
+            else simtools.build_network(
+                net_size=network_config["net_size"],
+                p=network_config["probability_follow"],
+                k_out=network_config["avg_n_friend"],
+                seed=network_config["seed"],
+                cache_dir=network_config["cache_dir"],
+            )
+        ),
+    )
+
+    # Timers of the hot paths, dumped at termination
+    PROFILER.configure(
+        rank=rank,
+        role=rank_role(rank, RANK_INDEX),
+        enabled=simulator_config["profile"],
+        max_events=simulator_config["profile_max_events"],
+    )
+
     if rank == RANK_INDEX["data_manager"]:
         run_data_manager(
-            users=users,
+            users=network.to_users(),
             comm_world=comm_world,
             rank=rank,
             size=size,
             rank_index=RANK_INDEX,
             batch_size=simulator_config["data_manager_batchsize"],
+            user_transfer=simulator_config["user_transfer"],
+            transport=simulator_config["transport"],
         )
 
     elif rank == RANK_INDEX["policy_filter"]:
@@ -107,12 +179,25 @@ def main():
             rank_index=RANK_INDEX,
         )
 
-    elif rank == RANK_INDEX["recommender_system"]:
+    elif rank in RANK_INDEX["recommender_system"]:
         run_recommender_system(
             comm_world=comm_world,
             rank=rank,
             size=size,
             rank_index=RANK_INDEX,
+            ranking_engine=simulator_config["ranking_engine"],
+            # Params for the message inventory
+            inventory_capacity=simulator_config["inventory_capacity"],
+            inventory_ttl=simulator_config["inventory_ttl"],
+            inventory_max_bytes=simulator_config["inventory_max_bytes"],
+            network=network,
+            user_transfer=simulator_config["user_transfer"],
+            transport=simulator_config["transport"],
+            # The analyzer needs the actions to check the convergence or to save them
+            # (with writer ranks, to cut their segments)
+            analyzer_stream=simulator_config["convergence_source"] == "stream"
+            or simulator_config["save_active_interactions"]
+            or simulator_config["save_passive_interactions"],
         )
 
     elif rank == RANK_INDEX["analyzer"]:
@@ -131,22 +216,76 @@ def main():
             ema_quality_method=simulator_config["ema_quality_method"],
             ema_quality_convergence=simulator_config["ema_quality_convergence"],
             # Number of users
-            n_users=len(users),
+            n_users=network.n_users,
             # Params for printing stuff during the execution
             verbose=simulator_config["verbose"],
             print_interval=simulator_config["print_interval"],
             # Params for saving activities on disk
             save_active_interactions=simulator_config["save_active_interactions"],
-            save_passive_interactions=simulator_config["save_passive_interactions"]
+            save_passive_interactions=simulator_config["save_passive_interactions"],
+            transport=simulator_config["transport"],
+            view_recording=simulator_config["view_recording"],
+            output_writer=simulator_config["output_writer"],
+            output_flush_rows=simulator_config["output_flush_rows"],
+            output_flush_interval=simulator_config["output_flush_interval"],
+            output_format=simulator_config["output_format"],
+            output_chunk_rows=simulator_config["output_chunk_rows"],
+            convergence_source=simulator_config["convergence_source"],
+            batch_size=simulator_config["data_manager_batchsize"],
+        )
+
+    elif rank in RANK_INDEX["writer"]:
+        run_writer(
+            comm_world=comm_world,
+            rank=rank,
+            size=size,
+            rank_index=RANK_INDEX,
+            # Params for saving activities on disk
+            save_active_interactions=simulator_config["save_active_interactions"],
+            save_passive_interactions=simulator_config["save_passive_interactions"],
+            transport=simulator_config["transport"],
+            view_recording=simulator_config["view_recording"],
+            output_writer=simulator_config["output_writer"],
+            output_flush_rows=simulator_config["output_flush_rows"],
+            output_flush_interval=simulator_config["output_flush_interval"],
+            output_format=simulator_config["output_format"],
+            output_chunk_rows=simulator_config["output_chunk_rows"],
         )
 
     elif rank == RANK_INDEX["agent_pool_manager"]:
         run_agent_pool_manager(
-            comm_world=comm_world, rank=rank, size=size, rank_index=RANK_INDEX
+            comm_world=comm_world,
+            rank=rank,
+            size=size,
+            rank_index=RANK_INDEX,
+            network=network,
+            transport=simulator_config["transport"],
+            # Params for the dispatch of the users to the agent handlers
+            agent_batchsize=simulator_config["agent_batchsize"],
+            agent_prefetch=simulator_config["agent_prefetch"],
+            agent_cost_weighted=simulator_config["agent_cost_weighted"],
         )
 
     elif rank >= RANK_INDEX["agent_handler"]:
-        run_agent(comm_world=comm_world, rank=rank, size=size, rank_index=RANK_INDEX)
+        run_agent(
+            comm_world=comm_world,
+            rank=rank,
+            size=size,
+            rank_index=RANK_INDEX,
+            network=network,
+            user_transfer=simulator_config["user_transfer"],
+            transport=simulator_config["transport"],
+            action_engine=simulator_config["action_engine"],
+            view_recording=simulator_config["view_recording"],
+            view_sample_rate=simulator_config["view_sample_rate"],
+            convergence_source=simulator_config["convergence_source"],
+        )
+
+    if PROFILER.enabled:
+        # The analyzer owns the output folder of the simulation
+        profiles = comm_world.gather(PROFILER.summary(), root=RANK_INDEX["analyzer"])
+        if rank == RANK_INDEX["analyzer"]:
+            write_profiles(folder_path, profiles)
 
 
 if __name__ == "__main__":
@@ -5,9 +5,13 @@ Put here function that can be used by more than one process.
 
 import os
 import csv
+import ast
 import random
+import numpy as np
 import igraph as ig
-from user import User
+from network import Network, cached_network, random_walk_network
+from message import ACTIVITY_COLUMNS
+from view import VIEW_COLUMNS
 
 MINIMUM_REQUIRED_ATTRIBS = {"uid", "utype", "postperday", "qualitydistr"}
 QUALITYDISTR = "(0.5, 0.15, 0, 1)"
@@ -37,7 +41,7 @@ def _delete_unused_attributes(net, desire_attribs):
     return net
 
 
-def init_network(file=None, net_size=200, p=0.5, k_out=3) -> dict:
+def init_graph(file=None, net_size=200, p=0.5, k_out=3) -> ig.Graph:
     """
     Create a network using a directed variant of the random-walk growth model
     https://journals.aps.org/pre/abstract/10.1103/PhysRevE.67.056104
@@ -48,11 +52,11 @@ def init_network(file=None, net_size=200, p=0.5, k_out=3) -> dict:
         friend (models network clustering)
     """
     if file:
-        graph = read_empirical_network(file)
-    else:
-        if net_size <= k_out + 1:  # if super small just return a clique
-            return ig.Graph.Full(net_size, directed=True)
+        return read_empirical_network(file)
 
+    if net_size <= k_out + 1:  # if super small just return a clique
+        graph = ig.Graph.Full(net_size, directed=True)
+    else:
         graph = ig.Graph.Full(k_out, directed=True)
         for n in range(k_out, net_size):
             target = random.choice(graph.vs)
@@ -71,34 +75,72 @@ def init_network(file=None, net_size=200, p=0.5, k_out=3) -> dict:
             graph.add_vertex(n)
             edges = [(n, f) for f in friends]
             graph.add_edges(edges)
-        for v in graph.vs:
-            v["uid"] = f"u{v.index}"
-            # v["utype"] = random.choice(["lurker", "normal user"])
-            v["utype"] = "normal user"
-            v["postperday"] = 0 if v["utype"] == "lurker" else random.uniform(0, 50)
-            v["qualitydistr"] = QUALITYDISTR
-
-    users = []
-    for node in graph.vs:
-        # remember link direction is following
-        friends = graph.successors(node.index)  # this returns the index of the vertex
-        followers = graph.predecessors(node.index)
-        user_i = User(
-            uid=graph.vs[node.index]["uid"],
-            user_class=graph.vs[node.index]["utype"],
-            post_per_day=int(graph.vs[node.index]["postperday"]),
-            quality_params=eval(graph.vs[node.index]["qualitydistr"]),
-            friends=["u" + str(u) for u in friends],
-            followers=["u" + str(u) for u in followers],
+    for v in graph.vs:
+        v["uid"] = f"u{v.index}"
+        # v["utype"] = random.choice(["lurker", "normal user"])
+        v["utype"] = "normal user"
+        v["postperday"] = 0 if v["utype"] == "lurker" else random.uniform(0, 50)
+        v["qualitydistr"] = QUALITYDISTR
+    return graph
+
+
+def build_network(
+    file=None, net_size=200, p=0.5, k_out=3, seed=None, cache_dir=None
+) -> Network:
+    """
+    Create the network in the compact CSR representation, either reading it from file
+    or generating it with the vectorized random-walk growth model
+    (network.random_walk_network, same model as init_graph).
+    The seed is used for the generation of the network and of the user topics.
+
+    If cache_dir is set and the network is reproducible (seed is set), the network is
+    stored in the cache keyed by its parameters and reused by later runs.
+    """
+    if cache_dir and seed is not None:
+        if file:
+            stat = os.stat(file)
+            params = {
+                "file": os.path.abspath(file),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+        else:
+            params = {"net_size": net_size, "p": p, "k_out": k_out}
+        params.update(seed=seed, quality_distribution=QUALITYDISTR)
+        return cached_network(
+            cache_dir,
+            params,
+            lambda: build_network(file=file, net_size=net_size, p=p, k_out=k_out, seed=seed),
         )
-        users.append(user_i)
-    return users
+    if file:
+        return Network.from_graph(
+            read_empirical_network(file), rng=np.random.default_rng(seed)
+        )
+    return random_walk_network(
+        net_size=net_size,
+        p=p,
+        k_out=k_out,
+        quality_params=ast.literal_eval(QUALITYDISTR),
+        seed=seed,
+    )
+
+
+def init_network(
+    file=None, net_size=200, p=0.5, k_out=3, seed=None, cache_dir=None
+) -> list:
+    """
+    Create the network (see build_network) and return the list of its users
+    """
+    return build_network(
+        file=file, net_size=net_size, p=p, k_out=k_out, seed=seed, cache_dir=cache_dir
+    ).to_users()
 
 
 def init_files(
     folder_path: str,
     file_path_activity: str,
     file_path_passivity: str,
+    passivity_columns: list = VIEW_COLUMNS["full"],
 ) -> None:
     """Generate empty files to persist actions
 
@@ -106,6 +148,7 @@ def init_files(
         folder_path (str): path of the folder based on time.now() function
         file_path_activity (str): path of the file that contains active actions
         file_path_passivity (str): path of the file that contains passive actions
+        passivity_columns (list): header of the passivity file (depends on the view recording)
     """
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
@@ -117,27 +160,22 @@ def init_files(
     with open(file_path_activity, "w", newline="", encoding="utf-8") as out_act:
         csv_out_act = csv.writer(out_act)
         if os.stat(file_path_activity).st_size == 0:
-            csv_out_act.writerow(
-                [
-                    "message_id",
-                    "user_id",
-                    "quality",
-                    "appeal",
-                    "reshared_id",
-                    "reshared_user_id",
-                    "reshared_original_id",
-                    "clock_time",
-                ]
-            )
+            csv_out_act.writerow(ACTIVITY_COLUMNS)
 
     with open(file_path_passivity, "w", newline="", encoding="utf-8") as out_pas:
         csv_out_pas = csv.writer(out_pas)
         if os.stat(file_path_passivity).st_size == 0:
-            csv_out_pas.writerow(
-                [
-                    "action_id",
-                    "user_id",
-                    "message_id",
-                    "message_user_id",
-                ]
-            )
+            csv_out_pas.writerow(passivity_columns)
+
+
+def user_shard(uid: int, n_shards: int) -> int:
+    """Index of the recommender system shard that owns the user
+
+    Args:
+        uid (int): user id
+        n_shards (int): number of recommender system ranks
+
+    Returns:
+        int: shard index in [0, n_shards)
+    """
+    return uid % n_shards
@@ -0,0 +1,307 @@
+"""
+Transport of the batches exchanged between the processes.
+By default objects are pickled by mpi4py (lowercase send/recv). With the buffer transport
+the batches of activations and actions are packed into structured numpy arrays and moved
+as a single byte buffer with the buffer-based Send/Recv:
+    header (kind, n. of activations, n. of messages, n. of views, view recording)
+    | activations | messages | views
+Control messages (pings and termination signals) are still pickled, the receiver tells
+them apart from the packed batches by the tag.
+The buffer transport only carries activations (see user.Activation), so it requires
+user_transfer = "delta".
+"""
+
+import numpy as np
+from mpi4py import MPI
+from message import Message
+from view import View, ViewRecords, VIEW_DTYPE, VIEW_RECORDINGS, pack_views
+from user import Activation
+from ranking import N_TOPICS
+
+# Tag of the packed batches (pickled objects are sent with the default tag 0)
+BUFFER_TAG = 7
+
+# Kinds of batch, they tell the receiver how to rebuild the object that was sent
+AGENT_REPLY = 0  # ("ping_agent_pool_manager", [(activation, messages, views), ...]): agent -> data manager
+USER_BATCH = 1  # [(activation, messages, views), ...]: data manager -> recommender system
+FEED_BATCH = 2  # [activation, ...]: recommender system -> agent pool manager -> agent
+ANALYZER_BATCH = 3  # [(activation, messages, views), ...]: recommender system -> analyzer
+WRITER_BATCH = 4  # [(activation, messages, views), ...]: agent (views) or data manager (messages) -> writer
+
+HEADER_SIZE = 5
+
+ACTIVATION_DTYPE = np.dtype(
+    [
+        ("uid", np.int64),
+        ("post_counter", np.int64),
+        ("repost_counter", np.int64),
+        ("view_counter", np.int64),
+        ("is_shadow", np.bool_),
+        ("n_feed", np.int64),
+        ("n_messages", np.int64),
+        ("n_views", np.int64),
+    ]
+)
+
+# Missing time and quality are packed as nan
+MESSAGE_DTYPE = np.dtype(
+    [
+        ("aid", np.int64),
+        ("uid", np.int64),
+        ("is_shadow", np.bool_),
+        ("appeal", np.float64),
+        ("quality", np.float64),
+        ("time", np.float64),
+        ("reshared_id", np.int64),
+        ("reshared_original_id", np.int64),
+        ("reshared_user_id", np.int64),
+        ("topics", np.float64, (N_TOPICS,)),
+    ]
+)
+
+def to_entries(kind: int, obj) -> list:
+    """Normalize the object sent with a given kind to a list of (activation, messages, views)"""
+    if kind == AGENT_REPLY:
+        return obj[1]
+    if kind in (USER_BATCH, WRITER_BATCH, ANALYZER_BATCH):
+        return obj
+    if kind == FEED_BATCH:
+        return [(activation, (), ()) for activation in obj]
+    raise ValueError(f"Unknown batch kind: {kind}")
+
+
+def from_entries(kind: int, entries: list):
+    """Rebuild the object sent with a given kind from the list of (activation, messages, views)"""
+    if kind == AGENT_REPLY:
+        return ("ping_agent_pool_manager", entries)
+    if kind in (USER_BATCH, WRITER_BATCH, ANALYZER_BATCH):
+        return entries
+    if kind == FEED_BATCH:
+        return [activation for activation, _, _ in entries]
+    raise ValueError(f"Unknown batch kind: {kind}")
+
+
+def nan_if_none(value) -> float:
+    return np.nan if value is None else value
+
+
+def pack_messages(messages: list) -> np.ndarray:
+    return np.array(
+        [
+            (
+                m.aid,
+                m.uid,
+                m.is_shadow,
+                m.appeal,
+                nan_if_none(m.quality),
+                nan_if_none(m.time),
+                m.reshared_id,
+                m.reshared_original_id,
+                m.reshared_user_id,
+                m.topics,
+            )
+            for m in messages
+        ],
+        dtype=MESSAGE_DTYPE,
+    )
+
+
+def unpack_messages(records: np.ndarray) -> list:
+    # Unpacking column-wise gives plain python values (topics back to lists of floats)
+    columns = [records[name].tolist() for name in MESSAGE_DTYPE.names]
+    messages = []
+    for (
+        aid,
+        uid,
+        is_shadow,
+        appeal,
+        quality,
+        time,
+        reshared_id,
+        reshared_original_id,
+        reshared_user_id,
+        topics,
+    ) in zip(*columns):
+        # Quality and appeal were already drawn by the author
+        messages.append(
+            Message.from_fields(
+                mid=aid,
+                uid=uid,
+                topics=topics,
+                is_shadow=is_shadow,
+                appeal=appeal,
+                quality=None if quality != quality else quality,
+                time=None if time != time else time,
+                reshared_id=reshared_id,
+                reshared_original_id=reshared_original_id,
+                reshared_user_id=reshared_user_id,
+            )
+        )
+    return messages
+
+
+def pack(kind: int, obj) -> np.ndarray:
+    """Pack a batch into a byte buffer
+
+    Args:
+        kind (int): kind of batch (e.g. USER_BATCH)
+        obj: object to send, in the shape expected for its kind
+
+    Returns:
+        np.ndarray: uint8 buffer
+    """
+    activations = []
+    messages = []
+    views = []
+    recording = "full"
+    for activation, active_actions, passive_actions in to_entries(kind, obj):
+        if passive_actions and isinstance(passive_actions[0], ViewRecords):
+            recording = passive_actions[0].recording
+        passive_actions = pack_views(passive_actions)
+        activations.append(
+            (
+                activation.uid,
+                activation.post_counter,
+                activation.repost_counter,
+                activation.view_counter,
+                activation.is_shadow,
+                len(activation.newsfeed),
+                len(active_actions),
+                len(passive_actions),
+            )
+        )
+        messages.extend(activation.newsfeed)
+        messages.extend(active_actions)
+        views.append(passive_actions)
+    views = np.concatenate(views) if views else np.zeros(0, dtype=VIEW_DTYPE)
+    header = np.array(
+        [kind, len(activations), len(messages), len(views), VIEW_RECORDINGS.index(recording)],
+        dtype=np.int64,
+    )
+    return np.concatenate(
+        [
+            header.view(np.uint8),
+            np.array(activations, dtype=ACTIVATION_DTYPE).view(np.uint8),
+            pack_messages(messages).view(np.uint8),
+            views.view(np.uint8),
+        ]
+    )
+
+
+def unpack(buffer: np.ndarray):
+    """Rebuild the object packed in a byte buffer
+
+    Args:
+        buffer (np.ndarray): uint8 buffer created by pack
+
+    Returns:
+        the object that was packed, in the shape expected for its kind
+    """
+    kind, n_activations, n_messages, n_views, recording = np.frombuffer(
+        buffer, dtype=np.int64, count=HEADER_SIZE
+    ).tolist()
+    offset = HEADER_SIZE * 8
+    activations = np.frombuffer(
+        buffer, dtype=ACTIVATION_DTYPE, count=n_activations, offset=offset
+    )
+    offset += activations.nbytes
+    messages = unpack_messages(
+        np.frombuffer(buffer, dtype=MESSAGE_DTYPE, count=n_messages, offset=offset)
+    )
+    offset += n_messages * MESSAGE_DTYPE.itemsize
+    views = np.frombuffer(buffer, dtype=VIEW_DTYPE, count=n_views, offset=offset)
+    recording = VIEW_RECORDINGS[recording]
+    if recording == "full":
+        views = [
+            View(vid=aid, uid=uid, parent_mid=parent_mid, parent_uid=parent_uid)
+            for aid, uid, parent_mid, parent_uid, _ in views.tolist()
+        ]
+
+    entries = []
+    m = v = 0
+    for (
+        uid,
+        post_counter,
+        repost_counter,
+        view_counter,
+        is_shadow,
+        n_feed,
+        n_active,
+        n_passive,
+    ) in activations.tolist():
+        activation = Activation(
+            uid=uid,
+            newsfeed=messages[m : m + n_feed],
+            post_counter=post_counter,
+            repost_counter=repost_counter,
+            view_counter=view_counter,
+            is_shadow=is_shadow,
+        )
+        m += n_feed
+        passive_actions = views[v : v + n_passive]
+        if recording != "full":
+            passive_actions = [ViewRecords(recording, passive_actions)] if n_passive else []
+        entries.append((activation, messages[m : m + n_active], passive_actions))
+        m += n_active
+        v += n_passive
+    return from_entries(kind, entries)
+
+
+class PickleTransport:
+    """Default transport: objects are pickled by mpi4py, the kind is ignored"""
+
+    def __init__(self, comm: MPI.Intercomm) -> None:
+        self.comm = comm
+
+    def send(self, obj, dest: int, kind: int = None) -> None:
+        self.comm.send(obj, dest=dest)
+
+    def isend(self, obj, dest: int, kind: int = None) -> MPI.Request:
+        return self.comm.isend(obj, dest=dest)
+
+    def recv(self, source: int = MPI.ANY_SOURCE, status: MPI.Status = None):
+        return self.comm.recv(source=source, status=status)
+
+
+class BufferTransport(PickleTransport):
+    """
+    Batches sent with a kind are packed into a byte buffer and moved with Send/Recv,
+    everything else is pickled as usual.
+    """
+
+    def send(self, obj, dest: int, kind: int = None) -> None:
+        if kind is None:
+            return super().send(obj, dest)
+        self.comm.Send([pack(kind, obj), MPI.BYTE], dest=dest, tag=BUFFER_TAG)
+
+    def isend(self, obj, dest: int, kind: int = None) -> MPI.Request:
+        if kind is None:
+            return super().isend(obj, dest)
+        # The request keeps a reference to the buffer until it completes
+        return self.comm.Isend([pack(kind, obj), MPI.BYTE], dest=dest, tag=BUFFER_TAG)
+
+    def recv(self, source: int = MPI.ANY_SOURCE, status: MPI.Status = None):
+        status = status if status is not None else MPI.Status()
+        self.comm.Probe(source=source, tag=MPI.ANY_TAG, status=status)
+        source, tag = status.Get_source(), status.Get_tag()
+        if tag != BUFFER_TAG:
+            return self.comm.recv(source=source, tag=tag, status=status)
+        buffer = np.empty(status.Get_count(MPI.BYTE), dtype=np.uint8)
+        self.comm.Recv([buffer, MPI.BYTE], source=source, tag=tag, status=status)
+        return unpack(buffer)
+
+
+TRANSPORTS = {"pickle": PickleTransport, "buffer": BufferTransport}
+
+
+def make_transport(comm: MPI.Intercomm, transport: str = "pickle") -> PickleTransport:
+    """Create the transport used by a process
+
+    Args:
+        comm (MPI.Intercomm): communicator of the processes
+        transport (str): "pickle" or "buffer"
+
+    Returns:
+        PickleTransport: the transport
+    """
+    return TRANSPORTS[transport](comm)
@@ -5,8 +5,9 @@ Original code has to be ported.
 
 from message import Message
 import random
-import pandas as pd
+import numpy as np
 from view import View
+from action import POST, RESHARE, VIEW, NO_ID, make_aid
 
 def generate_user_topics(total_topics=15, min_active=5, max_active=15):
     # Initialize all topics to 0
@@ -23,18 +24,41 @@ def generate_user_topics(total_topics=15, min_active=5, max_active=15):
 
 
 class User:
+    # Users are pickled and sent between processes on every activation, keep them compact
+    __slots__ = (
+        "uid",
+        "followers",
+        "friends",
+        "user_class",
+        "post_per_day",
+        "quality_params",
+        "cut_off",
+        "newsfeed",
+        "post_counter",
+        "repost_counter",
+        "view_counter",
+        "user_topics",
+        "is_suspended",
+        "is_shadow",
+        "mu",
+    )
+
     def __init__(
         self,
-        uid: str,
+        uid: int,
         user_class: str,
-        quality_params: str,
+        quality_params: tuple,
         post_per_day: float,
-        friends: list = [],
-        followers: list = [],
+        friends: np.ndarray = None,
+        followers: np.ndarray = None,
+        user_topics: np.ndarray = None,
     ):
         self.uid = uid
-        self.followers = followers
-        self.friends = friends
+        # uids of the users followed by / following the user (views of the network CSR arrays)
+        self.followers = np.asarray(
+            followers if followers is not None else [], dtype=np.int32
+        )
+        self.friends = np.asarray(friends if friends is not None else [], dtype=np.int32)
         self.user_class = user_class
         self.post_per_day = post_per_day
         self.quality_params = quality_params
@@ -45,7 +69,10 @@ class User:
         self.post_counter = 0
         self.repost_counter = 0
         self.view_counter = 0
-        self.user_topics = generate_user_topics()
+        self.user_topics = np.asarray(
+            user_topics if user_topics is not None else generate_user_topics(),
+            dtype=np.float32,
+        )
         self.is_suspended = False
         self.is_shadow = False
         self.mu = 0.5
@@ -88,7 +115,7 @@ class User:
         appeal_threshold = random.random()
         passive_actions = []
         for msg in self.newsfeed:
-            vid = "V" + str(self.view_counter) + "_" + self.uid
+            vid = make_aid(VIEW, self.uid, self.view_counter)
             v = View(vid=vid, uid=self.uid, parent_mid=msg.aid, parent_uid=msg.uid)
             passive_actions.append(v)
             self.view_counter += 1
@@ -97,7 +124,7 @@ class User:
         if not target:
             target = random.sample(list(self.newsfeed), 1)[0]
         message_reshared = Message(
-            mid="R" + str(self.repost_counter) + "_" + str(self.uid),
+            mid=make_aid(RESHARE, self.uid, self.repost_counter),
             uid=self.uid,
             quality_params=None,
             topics=target.topics,
@@ -107,7 +134,7 @@ class User:
         message_reshared.quality = target.quality
         message_reshared.appeal = target.appeal
         # If it's not the first reshare we get the attributes
-        if pd.notna(target.reshared_id):
+        if target.reshared_id != NO_ID:
             message_reshared.reshared_original_id = target.reshared_original_id
             message_reshared.reshared_id = target.aid
         else:
@@ -132,9 +159,9 @@ class User:
             Defaults to (0.5, 0.15, 0, 1).
         """
         message_created = Message(
-            mid="P" + str(self.post_counter) + "_" + str(self.uid),
+            mid=make_aid(POST, self.uid, self.post_counter),
             uid=self.uid,
-            topics=self.generate_message_vector(self.user_topics),
+            topics=self.generate_message_vector(self.user_topics.tolist()),
             is_shadow=self.is_shadow,
             quality_params=self.quality_params,
         )
@@ -201,3 +228,59 @@ class User:
                 f"- Description: {self.user_topics}",
             ]
         )
+
+
+class Activation:
+    """
+    What changes in a user during an activation. When the simulator runs with
+    user_transfer = "delta" the authoritative User objects live in the data manager:
+    the other processes rebuild the user from the shared network (Network.make_user)
+    and only exchange activations (feed and counters) instead of whole User objects.
+    """
+
+    __slots__ = (
+        "uid",
+        "newsfeed",
+        "post_counter",
+        "repost_counter",
+        "view_counter",
+        "is_shadow",
+    )
+
+    def __init__(
+        self,
+        uid: int,
+        newsfeed: list = None,
+        post_counter: int = 0,
+        repost_counter: int = 0,
+        view_counter: int = 0,
+        is_shadow: bool = False,
+    ) -> None:
+        self.uid = uid
+        self.newsfeed = newsfeed if newsfeed is not None else []
+        self.post_counter = post_counter
+        self.repost_counter = repost_counter
+        self.view_counter = view_counter
+        self.is_shadow = is_shadow
+
+    @classmethod
+    def from_user(cls, user: User, with_feed: bool = False):
+        """Activation with the current counters of the user (and its feed if requested)"""
+        return cls(
+            uid=user.uid,
+            newsfeed=user.newsfeed if with_feed else None,
+            post_counter=user.post_counter,
+            repost_counter=user.repost_counter,
+            view_counter=user.view_counter,
+            is_shadow=user.is_shadow,
+        )
+
+    def apply(self, user: User) -> User:
+        """Update the user with the counters (and the feed, if any) of the activation"""
+        if self.newsfeed:
+            user.newsfeed = self.newsfeed
+        user.post_counter = self.post_counter
+        user.repost_counter = self.repost_counter
+        user.view_counter = self.view_counter
+        user.is_shadow = self.is_shadow
+        return user
@@ -1,12 +1,206 @@
-from action import Action
+import numpy as np
+from action import Action, NO_ID, format_aid, format_uid
+
+# How the views are recorded:
+#   full: one View object (and one row on disk) per view
+#   sampled: a Bernoulli sample of the views
+#   aggregated: number of views per (viewer, message)
+#   exposure: number of views per message
+# Aggregated and exposure views are counted per activation by the agent handlers and
+# summed over the whole run by the output writer (see output_writer.ViewCounts)
+VIEW_RECORDINGS = ("full", "sampled", "aggregated", "exposure")
+
+# Columns of the passivity file for each recording
+VIEW_COLUMNS = {
+    "full": ["action_id", "user_id", "message_id", "message_user_id"],
+    "sampled": ["action_id", "user_id", "message_id", "message_user_id"],
+    "aggregated": ["user_id", "message_id", "message_user_id", "n_views"],
+    "exposure": ["message_id", "message_user_id", "n_views"],
+}
+
+# Compact views (fields that a recording drops are set to NO_ID)
+VIEW_DTYPE = np.dtype(
+    [
+        ("aid", np.int64),
+        ("uid", np.int64),
+        ("parent_mid", np.int64),
+        ("parent_uid", np.int64),
+        ("count", np.int64),
+    ]
+)
+
+# Field of the compact views holding each column of the passivity file
+VIEW_FIELDS = {
+    "action_id": "aid",
+    "user_id": "uid",
+    "message_id": "parent_mid",
+    "message_user_id": "parent_uid",
+    "n_views": "count",
+}
 
 
 class View(Action):
-    def __init__(self, vid: str, uid: str, parent_mid: str, parent_uid: str) -> None:
+    __slots__ = ("parent_mid", "parent_uid")
+
+    def __init__(self, vid: int, uid: int, parent_mid: int, parent_uid: int) -> None:
         Action.__init__(self, vid, uid)
         self.parent_mid = parent_mid
         self.parent_uid = parent_uid
 
     def write_action(self):
         parent_action = super().write_action()
-        return (*parent_action, self.parent_mid, self.parent_uid)
+        return (*parent_action, format_aid(self.parent_mid), format_uid(self.parent_uid))
+
+
+class ViewRecords:
+    """Views of an activation recorded as a structured array (see VIEW_RECORDINGS)"""
+
+    __slots__ = ("recording", "records")
+
+    def __init__(self, recording: str, records: np.ndarray) -> None:
+        self.recording = recording
+        self.records = records
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def write_actions(self) -> list:
+        """Rows to write on disk, with the columns of VIEW_COLUMNS[recording]
+
+        Returns:
+            list: one tuple per record
+        """
+        if self.recording == "sampled":
+            return [
+                (format_aid(aid), format_uid(uid), format_aid(mid), format_uid(muid))
+                for aid, uid, mid, muid in zip(
+                    self.records["aid"].tolist(),
+                    self.records["uid"].tolist(),
+                    self.records["parent_mid"].tolist(),
+                    self.records["parent_uid"].tolist(),
+                )
+            ]
+        if self.recording == "aggregated":
+            return [
+                (format_uid(uid), format_aid(mid), format_uid(muid), count)
+                for uid, mid, muid, count in zip(
+                    self.records["uid"].tolist(),
+                    self.records["parent_mid"].tolist(),
+                    self.records["parent_uid"].tolist(),
+                    self.records["count"].tolist(),
+                )
+            ]
+        return [
+            (format_aid(mid), format_uid(muid), count)
+            for mid, muid, count in zip(
+                self.records["parent_mid"].tolist(),
+                self.records["parent_uid"].tolist(),
+                self.records["count"].tolist(),
+            )
+        ]
+
+
+def pack_views(passive_actions: list) -> np.ndarray:
+    """View objects or ViewRecords of a user as compact views"""
+    if passive_actions and isinstance(passive_actions[0], ViewRecords):
+        return np.concatenate([views.records for views in passive_actions])
+    return np.array(
+        [(v.aid, v.uid, v.parent_mid, v.parent_uid, 1) for v in passive_actions],
+        dtype=VIEW_DTYPE,
+    )
+
+
+def trim_views(passive_actions: list, uid: int) -> list:
+    """Passive actions up to (and including) the last view of a user
+
+    Args:
+        passive_actions (list): View objects or ViewRecords, in the order they are written
+        uid (int): id of the viewer
+
+    Returns:
+        list: the passive actions, without the views written after the last one of uid
+    """
+    for i in range(len(passive_actions) - 1, -1, -1):
+        action = passive_actions[i]
+        if isinstance(action, ViewRecords):
+            rows = np.flatnonzero(action.records["uid"] == uid)
+            if len(rows):
+                records = action.records[: rows[-1] + 1]
+                return passive_actions[:i] + [ViewRecords(action.recording, records)]
+        elif action.uid == uid:
+            return passive_actions[: i + 1]
+    return []
+
+
+def compact_views(
+    uid: int,
+    vids: np.ndarray,
+    parent_mids: np.ndarray,
+    parent_uids: np.ndarray,
+    recording: str,
+    sample_rate: float,
+    rng: np.random.Generator,
+) -> list:
+    """Record the views of a user with a compact recording
+
+    Args:
+        uid (int): id of the viewer
+        vids (np.ndarray): ids of the views
+        parent_mids (np.ndarray): ids of the viewed messages
+        parent_uids (np.ndarray): ids of the authors of the viewed messages
+        recording (str): "sampled", "aggregated" or "exposure"
+        sample_rate (float): probability to keep a view when sampling
+        rng (np.random.Generator): random generator
+
+    Returns:
+        list: passive actions of the user (a single ViewRecords, or nothing)
+    """
+    if recording == "sampled":
+        kept = rng.random(len(vids)) < sample_rate
+        records = np.zeros(kept.sum(), dtype=VIEW_DTYPE)
+        records["aid"] = vids[kept]
+        records["uid"] = uid
+        records["parent_mid"] = parent_mids[kept]
+        records["parent_uid"] = parent_uids[kept]
+        records["count"] = 1
+    else:
+        # Counts of this activation, summed across activations by the output writer
+        # (message ids already encode their author)
+        mids, first, counts = np.unique(parent_mids, return_index=True, return_counts=True)
+        records = np.zeros(len(mids), dtype=VIEW_DTYPE)
+        records["aid"] = NO_ID
+        records["uid"] = uid if recording == "aggregated" else NO_ID
+        records["parent_mid"] = mids
+        records["parent_uid"] = parent_uids[first]
+        records["count"] = counts
+    return [ViewRecords(recording, records)] if len(records) else []
+
+
+def record_views(
+    views: list,
+    recording: str = "full",
+    sample_rate: float = 0.1,
+    rng: np.random.Generator = None,
+) -> list:
+    """Convert the View objects of an activation to the given recording
+
+    Args:
+        views (list): View objects of a single user
+        recording (str): one of VIEW_RECORDINGS
+        sample_rate (float): probability to keep a view when sampling
+        rng (np.random.Generator): random generator
+
+    Returns:
+        list: passive actions of the user
+    """
+    if recording == "full" or not views:
+        return views
+    return compact_views(
+        uid=views[0].uid,
+        vids=np.array([view.aid for view in views], dtype=np.int64),
+        parent_mids=np.array([view.parent_mid for view in views], dtype=np.int64),
+        parent_uids=np.array([view.parent_uid for view in views], dtype=np.int64),
+        recording=recording,
+        sample_rate=sample_rate,
+        rng=rng,
+    )
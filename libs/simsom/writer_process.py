@@ -0,0 +1,115 @@
+"""
+A writer persists the actions of the agent handlers assigned to it (see assigned_writer):
+the views come from the agent handlers, the messages from the data manager once it
+assigned their clock time.
+Each writer rank writes its own segment of the output files (e.g. activities-w0.csv),
+the segments are listed by the analyzer in an index file (see output_writer.write_index).
+With writer ranks the analyzer only receives the statistics it needs for convergence.
+"""
+
+from mpi4py import MPI
+from transport import make_transport
+from output_writer import open_output, segment_path
+from instrumentation import PROFILER
+
+
+def assigned_writer(agent_rank: int, rank_index: dict) -> int:
+    """Rank of the writer that persists the actions of an agent handler
+
+    Args:
+        agent_rank (int): rank of the agent handler
+        rank_index (dict): rank layout of the simulation
+
+    Returns:
+        int: rank of the writer
+    """
+    writer_ranks = rank_index["writer"]
+    return writer_ranks[(agent_rank - rank_index["agent_handler"]) % len(writer_ranks)]
+
+
+def run_writer(
+    comm_world: MPI.Intercomm,
+    rank: int,
+    size: int,
+    rank_index: dict,
+    # Params for saving activities on disk
+    save_active_interactions: bool = True,
+    save_passive_interactions: bool = True,
+    # Pickled objects or packed buffers
+    transport: str = "pickle",
+    # How the views are recorded (see view.VIEW_RECORDINGS)
+    view_recording: str = "full",
+    # Params for the writer of the output files (see output_writer)
+    output_writer: str = "direct",
+    output_flush_rows: int = 10000,
+    output_flush_interval: float = 1.0,
+    output_format: str = "csv",
+    output_chunk_rows: int = 100000,
+):
+
+    # Verbose: use flush=True to print messages
+    # print(f"- Writer @{rank} >> started", flush=True)
+
+    # Status of the processes
+    status = MPI.Status()
+
+    # Pickled objects or packed buffers
+    channel = make_transport(comm_world, transport)
+
+    # Agent handlers assigned to this writer
+    n_agents = sum(
+        assigned_writer(agent_rank, rank_index) == rank
+        for agent_rank in range(rank_index["agent_handler"], size)
+    )
+    segment = rank_index["writer"].index(rank)
+
+    # The analyzer decides where the output goes
+    file_path_activity, file_path_passivity = comm_world.recv(
+        source=rank_index["analyzer"]
+    )
+    file_path_activity = segment_path(file_path_activity, segment)
+    file_path_passivity = segment_path(file_path_passivity, segment)
+    writer = open_output(
+        file_path_activity,
+        file_path_passivity,
+        view_recording=view_recording,
+        save_active_interactions=save_active_interactions,
+        save_passive_interactions=save_passive_interactions,
+        output_writer=output_writer,
+        output_flush_rows=output_flush_rows,
+        output_flush_interval=output_flush_interval,
+        output_format=output_format,
+        output_chunk_rows=output_chunk_rows,
+    )
+
+    # Bootstrap sync
+    comm_world.Barrier()
+
+    # Number of agent handlers (and data manager) that sent the termination signal
+    n_closed = 0
+
+    while n_closed < n_agents + 1:
+
+        # Get the actions of a batch from any agent handler or from the data manager
+        with PROFILER.phase("recv"):
+            data = channel.recv(source=MPI.ANY_SOURCE, status=status)
+
+        if data == "sigterm":
+            n_closed += 1
+            continue
+
+        with PROFILER.phase("write"):
+            for _, active_actions, passive_actions in data:
+                if save_active_interactions:
+                    writer.write("activity", active_actions)
+                if save_passive_interactions:
+                    writer.write("passivity", passive_actions)
+
+    # print(f"- Writer @{rank} >> termination signal", flush=True)
+    with PROFILER.phase("close"):
+        writer.close()
+
+    # Flush pending incoming messages so we can exit cleanly
+    while comm_world.Iprobe(source=MPI.ANY_SOURCE, status=status):
+        _ = channel.recv(source=MPI.ANY_SOURCE, status=status)
+    comm_world.Barrier()